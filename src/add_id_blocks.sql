@@ -0,0 +1,7 @@
+CREATE TABLE id_block (
+  table_name VARCHAR(50), 
+  next_id BIGINT, 
+  PRIMARY KEY(table_name)
+);
+
+INSERT INTO id_block VALUES ('drone', 1), ('operator', 1);
\ No newline at end of file
@@ -0,0 +1,20 @@
+ALTER TABLE map ADD COLUMN row_version BIGINT DEFAULT 0, ADD INDEX(row_version);
+
+ALTER TABLE drone ADD COLUMN row_version BIGINT DEFAULT 0, ADD INDEX(row_version);
+
+ALTER TABLE operator ADD COLUMN row_version BIGINT DEFAULT 0, ADD INDEX(row_version);
+
+CREATE TABLE removed_drone (
+  drone_id INT, 
+  row_version BIGINT, 
+  PRIMARY KEY(drone_id),
+  INDEX(row_version)
+);
+
+CREATE TABLE sync_version (
+  id INT, 
+  version BIGINT, 
+  PRIMARY KEY(id)
+);
+
+INSERT INTO sync_version VALUES (1, 0);
\ No newline at end of file
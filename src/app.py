@@ -1,37 +1,94 @@
-import mysql.connector
+import os
+import sys
 import Tkinter as tk
+from bisect import bisect_left
+import tkMessageBox
 import ttk
 
+import numpy as np
+
 from drones import Drone, DroneStore
 from operators import Operator, OperatorStore
 from maps import Map, MapStore
+from backends import backend_from_config, local_path_from_config
+from dbworker import DatabaseWorker
+from mapimages import MapImageCache, TiledMap
+from metrics import metrics, timed
+from snapshot import merge_rows, read_snapshot, write_snapshot
+from startup import StartupTimer, StoreLoader, show_timings_from_config
+from telemetry import TelemetryReceiver, telemetry_port_from_config
 from trackingsystem import TrackingSystem, DroneLocation
+from unitofwork import UnitOfWork
+
+# How often (in milliseconds) the application checks whether pending changes are due to be written
+FLUSH_INTERVAL = 500
+
+# How often (in milliseconds) the application fetches the changes made by other instances
+SYNC_INTERVAL = 5000
+
+# How often (in milliseconds) the received position reports are applied to the tracker
+INGEST_INTERVAL = 50
+
+# How often (in milliseconds) a replay moves on, and how far (in seconds of history) it moves
+REPLAY_INTERVAL = 100
+REPLAY_STEP = 1.0
+
+# How many times a second a map in live mode is redrawn with the latest drone positions
+LIVE_RATE = 5.0
+
+# How often (in milliseconds) the metrics are written to the metrics file, when one is set
+METRICS_INTERVAL = 60000
+
+# Number of rows added to a list window each time the user scrolls near the end of the list
+LIST_PAGE_SIZE = 200
 
 
 class Application(object):
     """ Main application view - displays the menu. """
 
-    def __init__(self, conn):
-        # Initialise the stores
-        self.drones = DroneStore(conn)
-        self.operators = OperatorStore(conn)
-        self.maps = MapStore(conn)
-        self.tracker = TrackingSystem()
-
-        # Assign drones to their maps
-        for drone in self.drones.list_all():
-            if drone.map != None:
-                map_name = drone.map
-                drone.map = self.maps.get(map_name)
-                drone.location = self.tracker.retrieve(drone.map, drone)
-            
+    def __init__(self, backend, background_writes=True, show_timings=False, snapshot_path=None,
+                 history_path=None, telemetry_port=None, metrics_path=None):
+        self.startup_timer = StartupTimer()
+        self._show_timings = show_timings
+        # Statistics on the stores, database and windows are only kept when they are written out
+        self._metrics_path = metrics_path
+        if metrics_path is not None:
+            metrics.enabled = True
+        # Local copy of the stores that lets the next start load only the changes
+        self._snapshot_path = snapshot_path
+        self._source = backend.identity()
+        self._backend = backend
+        # Functions called with the (kind, ID) keys of records changed and removed by others
+        self._change_listeners = []
+        self._syncing = False
+
+        # Initialise the empty stores - changes to drones and operators are written in batches
+        self.unit_of_work = UnitOfWork(backend)
+        self.drones = DroneStore(None, self.unit_of_work, self._drone_loaded)
+        self.operators = OperatorStore(None, self.unit_of_work)
+        self.maps = MapStore()
+        self.tracker = TrackingSystem(history_path)
+        # Drones loaded before the maps, which are tracked once the maps are in
+        self._untracked = []
+        # Drones created before the maps, which keep their map name until the maps are in
+        self._unresolved = []
+
         # Initialise the GUI window
         self.root = tk.Tk()
         self.root.title('Drone Allocation and Localisation')
+        self.root.protocol('WM_DELETE_WINDOW', self.close)
+        self.map_images = MapImageCache()
+
+        # Writes go through a worker thread with its own connection to the backend
+        self.db_worker = None
+        if background_writes:
+            self.db_worker = DatabaseWorker(backend.connect, self.root)
+            self.unit_of_work.worker = self.db_worker
+
         frame = tk.Frame(self.root)
         frame.pack(padx=10, pady=10)
 
-        # Add in the buttons
+        # Add in the buttons - each is enabled once the stores it needs have loaded
         drone_button = tk.Button(
             frame, text="View Drones", command=self.view_drones, width=40, padx=5, pady=5)
         drone_button.pack(side=tk.TOP)
@@ -44,14 +101,273 @@ class Application(object):
         allocate_button = tk.Button(
             frame, text="Allocate Drone", command=self.view_drone_allocation, width=40, padx=5, pady=5)
         allocate_button.pack(side=tk.TOP)
+        allocate_all_button = tk.Button(
+            frame, text="Allocate Free Drones", command=self.allocate_free_drones, width=40,
+            padx=5, pady=5)
+        allocate_all_button.pack(side=tk.TOP)
+        self._store_buttons = [(drone_button, ('drones', 'maps')),
+                               (operator_button, ('drones', 'operators', 'maps')),
+                               (map_button, ('drones', 'maps')),
+                               (allocate_button, ('drones', 'operators', 'maps')),
+                               (allocate_all_button, ('drones', 'operators', 'maps'))]
         exit_button = tk.Button(frame, text="Exit System",
-                                command=quit, width=40, padx=5, pady=5)
+                                command=self.close, width=40, padx=5, pady=5)
         exit_button.pack(side=tk.TOP)
 
+        # Show whether changes are still being saved or have failed
+        self.status_var = tk.StringVar(self.root)
+        status_label = tk.Label(frame, textvariable=self.status_var)
+        status_label.pack(side=tk.TOP)
+        self.unit_of_work.add_listener(self._save_state_changed)
+
+        self.root.after(FLUSH_INTERVAL, self.flush_changes)
+        if metrics_path is not None:
+            self.root.after(METRICS_INTERVAL, self.dump_metrics)
+        self.startup_timer.add('window', self.startup_timer.elapsed())
+
+        # Position reports from the drones, when telemetry is enabled
+        self.telemetry = None
+        if telemetry_port is not None:
+            self.telemetry = TelemetryReceiver(telemetry_port)
+            self.root.after(INGEST_INTERVAL, self.ingest_telemetry)
+
+        self._load_errors = []
+        self.loader = StoreLoader(backend.connect, self.startup_timer, self.root)
+        self._start_loading(backend)
+        self._update_buttons()
+        self._save_state_changed([])
+
+    def _start_loading(self, backend):
+        """ Starts filling the stores from the snapshot and the changes made since it was
+        written, or from a full load of the database if there is no usable snapshot. """
+        # The database version the stores are up to date with once they have loaded
+        self.sync_version = backend.current_version()
+        snapshot = None
+        if self._snapshot_path is not None and self._source is not None:
+            with self.startup_timer.phase('read snapshot'):
+                snapshot = read_snapshot(self._snapshot_path, self._source, self.sync_version)
+
+        on_done = dict((name, lambda error, name=name: self._store_loaded(name, error))
+                       for name in ('maps', 'drones', 'operators'))
+        if snapshot is not None:
+            version, drone_rows, operator_rows, map_rows = snapshot
+            with self.startup_timer.phase('fetch changes'):
+                self.sync_version, drones, operators, maps, removed = \
+                    backend.load_changes(version)
+            self.loader.add('maps', merge_rows(map_rows, maps), self.maps.load_rows,
+                            on_done['maps'])
+            self.loader.add('drones', merge_rows(drone_rows, drones, removed),
+                            self._drone_rows_loaded, on_done['drones'])
+            self.loader.add('operators', merge_rows(operator_rows, operators),
+                            self.operators.load_rows, on_done['operators'])
+        else:
+            # Load the stores at the same time, each on its own connection
+            self.loader.load('maps', lambda backend, size: backend.load_maps(size),
+                             self.maps.load_rows, on_done['maps'])
+            self.loader.load('drones', lambda backend, size: backend.load_drones(size),
+                             self._drone_rows_loaded, on_done['drones'])
+            self.loader.load('operators', lambda backend, size: backend.load_operators(size),
+                             self.operators.load_rows, on_done['operators'])
+
+    def finish_loading(self):
+        """ Waits until every store has loaded. """
+        self.loader.finish()
+
+    def _drone_rows_loaded(self, rows):
+        """ Adds a batch of drones to the store and starts tracking them. """
+        ids = self.drones.load_rows(rows)
+        if 'maps' in self.loader.loading():
+            self._untracked.extend(ids)
+        else:
+            self._track_drones(ids)
+
+    def _track_drones(self, ids):
+        """ Starts tracking drones on their maps - the Drone objects are created when first
+        used. """
+        drones_by_map = {}
+        for drone_id, map_name in self.drones.list_maps(ids):
+            drones_by_map.setdefault(map_name, []).append(drone_id)
+        for map_name, drone_ids in drones_by_map.iteritems():
+            self.tracker.track_many(self.maps.get(map_name), drone_ids)
+
+    def _store_loaded(self, name, error):
+        """ Records that a store has finished loading. """
+        if error is not None:
+            self._load_errors.append("Could not load %s: %s" % (name, error))
+        if name == 'maps':
+            with self.startup_timer.phase('track drones'):
+                self._track_drones(self._untracked)
+            self._untracked = []
+            for drone in self._unresolved:
+                self._resolve_map(drone)
+            self._unresolved = []
+        self._update_buttons()
+        self._save_state_changed([])
+        if not self.loader.loading():
+            self.startup_timer.add('total', self.startup_timer.elapsed())
+            if metrics.enabled:
+                for phase, seconds in self.startup_timer.phases():
+                    metrics.observe('startup.' + phase.replace(' ', '_'), seconds)
+            if self._show_timings:
+                print('Startup timings:\n%s' % self.startup_timer.report())
+            if not self._load_errors:
+                self.root.after(SYNC_INTERVAL, self.sync_changes)
+
+    def add_change_listener(self, listener):
+        """ Adds a function called with the (kind, ID) keys of the records changed and those
+        removed when changes made by other instances are applied. """
+        self._change_listeners.append(listener)
+
+    def remove_change_listener(self, listener):
+        """ Removes a listener added with add_change_listener. """
+        self._change_listeners.remove(listener)
+
+    def sync_changes(self):
+        """ Fetches the changes other instances have written since the last fetch, and
+        schedules the next one. """
+        self.root.after(SYNC_INTERVAL, self.sync_changes)
+        if self._syncing:
+            return
+        version = self.sync_version
+        if self.db_worker is not None:
+            self._syncing = True
+            self.db_worker.submit(lambda backend: backend.load_changes(version),
+                                  self.apply_changes, self._sync_failed)
+        else:
+            self.apply_changes(self._backend.load_changes(version))
+
+    def _sync_failed(self, error):
+        # Try again at the next interval
+        self._syncing = False
+
+    @timed('app.apply_changes')
+    def apply_changes(self, changes):
+        """ Applies a set of changes from load_changes to the stores and the open windows. """
+        self._syncing = False
+        version, drone_rows, operator_rows, map_rows, removed = changes
+        self.maps.apply_changes(map_rows)
+        changed_drones, removed_drones = self.drones.apply_changes(drone_rows, removed)
+        changed_operators = self.operators.apply_changes(operator_rows)
+        self.sync_version = max(self.sync_version, version)
+
+        self.tracker.untrack(removed_drones)
+        self._track_drones(changed_drones)
+        changed = ([('drone', id) for id in changed_drones] +
+                   [('operator', id) for id in changed_operators])
+        removed = [('drone', id) for id in removed_drones]
+        if changed or removed:
+            for listener in list(self._change_listeners):
+                listener(changed, removed)
+
+    def _update_buttons(self):
+        """ Enables the buttons whose stores have loaded. """
+        loading = self.loader.loading()
+        for button, stores in self._store_buttons:
+            ready = not [store for store in stores if store in loading]
+            button.config(state=tk.NORMAL if ready else tk.DISABLED)
+
+    def _drone_loaded(self, drone):
+        """ Assigns a drone loaded from the database to its map. """
+        if 'maps' in self.loader.loading():
+            # Saving the drone still writes the map name it was loaded with
+            self._unresolved.append(drone)
+        else:
+            self._resolve_map(drone)
+
+    def _resolve_map(self, drone):
+        if drone.map != None and not isinstance(drone.map, Map):
+            map_name = drone.map
+            drone.map = self.maps.get(map_name)
+        drone.location = self.tracker.retrieve(drone.map, drone)
+
     def main_loop(self):
         """ Main execution loop - start Tkinter. """
         self.root.mainloop()
 
+    def flush_changes(self):
+        """ Writes any pending changes that are due and schedules the next check. """
+        self.unit_of_work.flush_if_due()
+        self.root.after(FLUSH_INTERVAL, self.flush_changes)
+
+    def dump_metrics(self):
+        """ Writes the metrics to the metrics file and schedules the next write. """
+        self._write_metrics()
+        self.root.after(METRICS_INTERVAL, self.dump_metrics)
+
+    def _write_metrics(self):
+        if self._metrics_path is None:
+            return
+        try:
+            metrics.dump(self._metrics_path)
+        except (IOError, OSError):
+            # Tried again at the next interval
+            pass
+
+    @timed('app.ingest_telemetry')
+    def ingest_telemetry(self):
+        """ Moves the drones to their latest reported positions and schedules the next tick. """
+        reports = self.telemetry.take()
+        if len(reports):
+            self.tracker.apply_reports(reports['drone_id'], reports['x'], reports['y'])
+        self.root.after(INGEST_INTERVAL, self.ingest_telemetry)
+
+    def _save_state_changed(self, keys):
+        """ Updates the save status shown in the main window. """
+        failures = self.unit_of_work.failures()
+        waiting = self.unit_of_work.pending() + self.unit_of_work.saving()
+        if self._load_errors:
+            self.status_var.set(self._load_errors[0])
+        elif self.loader.loading():
+            self.status_var.set("Loading %s..." % ', '.join(sorted(self.loader.loading())))
+        elif failures:
+            self.status_var.set("%d change(s) could not be saved: %s" %
+                                (len(failures), failures.values()[0]))
+        elif waiting:
+            self.status_var.set("Saving %d change(s)..." % waiting)
+        else:
+            self.status_var.set("All changes saved")
+
+    def close(self):
+        """ Writes any pending changes and closes the application. If they cannot be written,
+        the user can try again or quit without them. """
+        if self.db_worker is not None:
+            # Wait for the worker, then retry anything it failed to write on this thread
+            self.unit_of_work.flush()
+            self.db_worker.stop()
+            self.db_worker = None
+            self.unit_of_work.worker = None
+        while True:
+            try:
+                self.unit_of_work.flush()
+                break
+            except Exception as error:
+                if not tkMessageBox.askyesno(
+                        "Exit", "%d changes could not be saved:\n%s\n\nTry again? If not, they "
+                        "will be lost." % (self.unit_of_work.pending(), error), parent=self.root):
+                    break
+        try:
+            self._write_snapshot()
+            if self.telemetry is not None:
+                self.telemetry.stop()
+            self.tracker.close()
+            self._write_metrics()
+        finally:
+            self.root.destroy()
+
+    def _write_snapshot(self):
+        """ Saves the stores to the snapshot file, if they loaded fully and every change has
+        been saved. """
+        if (self._snapshot_path is None or self._source is None or self.loader.loading() or
+                self._load_errors or self.unit_of_work.failures()):
+            return
+        try:
+            write_snapshot(self._snapshot_path, self._source, self.sync_version,
+                           list(self.drones.list_rows()), list(self.operators.list_rows()),
+                           list(self.maps.list_rows()))
+        except (IOError, OSError):
+            # The next start does a full load instead
+            pass
+
     def view_operators(self):
         """ Display the operators. """
         wnd = OperatorListWindow(self)
@@ -72,6 +388,24 @@ class Application(object):
         wnd = AllocationWindow(self)
         self.root.wait_window(wnd.root)
 
+    @timed('app.allocate_free_drones')
+    def allocate_free_drones(self):
+        """ Allocates as many of the free drones as possible to the free operators, preferring
+        the most experienced operators. """
+        drones = [drone for drone in self.drones.list_all() if drone.operator is None]
+        operators = list(self.operators.list_free())
+        plan = self.drones.allocate_many(drones, operators, weighted=True)
+        if not plan.pairs:
+            tkMessageBox.showinfo("Allocate Free Drones", "No free drones can be allocated.",
+                                  parent=self.root)
+            return
+        if not tkMessageBox.askokcancel(
+                "Allocate Free Drones", "Allocate %d of the %d free drones?" %
+                (len(plan.pairs), len(drones)), parent=self.root):
+            return
+        self.operators.commit_plan(plan)
+
+
 class AllocationWindow(object):
 
     def __init__(self, parent):
@@ -79,6 +413,7 @@ class AllocationWindow(object):
         self.drones = parent.drones
         self.maps = parent.maps
         self.operators = parent.operators
+        self.unit_of_work = parent.unit_of_work
 
         # Initialise the new top-level window (modal dialog)
         self._parent = parent.root
@@ -96,25 +431,26 @@ class AllocationWindow(object):
 
         drone_label = tk.Label(self.frame, text="Drone:")
         self.drone_var = tk.StringVar(self.frame)
-        options_drones = []
-        for drone in self.drones.list_all():
-            options_drones.append(drone.name)
+        options_drones = sorted(self.drones.list_names())
         self.drone_var.set(options_drones[0])
         drone_dropdown = tk.OptionMenu(self.frame, self.drone_var, *options_drones)
 
+        # The operator list only shows the free operators who can fly the selected drone
         operator_label = tk.Label(self.frame, text="Operator:")
         self.operator_var = tk.StringVar(self.frame)
-        options_operators = []
-        for operator in self.operators.list_all():
-            options_operators.append(operator.first_name + ' ' + operator.family_name)
-        self.operator_var.set(options_operators[0])
-        operator_dropdown = tk.OptionMenu(self.frame, self.operator_var, *options_operators)
+        self.operator_dropdown = tk.OptionMenu(self.frame, self.operator_var, '')
+        self.eligible_var = tk.IntVar(self.frame, value=1)
+        eligible_check = tk.Checkbutton(self.frame, text="Eligible only", variable=self.eligible_var,
+                                        command=self.update_operators)
+        self.drone_var.trace('w', self.update_operators)
+        self.update_operators()
 
         drone_label.grid(in_=self.frame, row=0, column=0, sticky=tk.W)
         drone_dropdown.grid(in_=self.frame, row=0, column=1, sticky=tk.W)
         
         operator_label.grid(in_=self.frame, row=1, column=0, sticky=tk.W)
-        operator_dropdown.grid(in_=self.frame, row=1, column=1, sticky=tk.W)
+        self.operator_dropdown.grid(in_=self.frame, row=1, column=1, sticky=tk.W)
+        eligible_check.grid(in_=self.frame, row=1, column=2, sticky=tk.W)
 
         self.errors_text = tk.Text(self.frame, height=5, width=30)
         self.errors_text.grid(in_=self.frame, row=2, column=0, sticky=tk.EW)
@@ -134,31 +470,47 @@ class AllocationWindow(object):
                                 command=self.close, width=20, padx=5, pady=5)
         exit_button.grid(in_=self.frame, row=5, column=1, sticky=tk.E)
     
+    def update_operators(self, *args):
+        """ Fills the operator list for the selected drone. """
+        drones = self.drones.find_by_name(self.drone_var.get())
+        if self.eligible_var.get() and len(drones) == 1:
+            options = sorted(self.operators.list_eligible_names(drones[0]))
+        else:
+            options = sorted(self.operators.list_names())
+        menu = self.operator_dropdown['menu']
+        menu.delete(0, tk.END)
+        for name in options:
+            menu.add_command(label=name, command=tk._setit(self.operator_var, name))
+        self.operator_var.set(options[0] if options else '')
+        self.checked = False
+
     def check(self):
         self.checked = True
         self.errors_text.delete('1.0', tk.END)
-        drone_to_allocate = None
-        operator_to_allocate = None
-        for drone in self.drones.list_all():
-            if drone.name == self.drone_var.get():
-                drone_to_allocate = drone
-        for operator in self.operators.list_all():
-            if operator.first_name + ' ' + operator.family_name == self.operator_var.get():
-                operator_to_allocate = operator
-
-        self.action = self.drones.allocate(drone_to_allocate, operator_to_allocate)
+        drones = self.drones.find_by_name(self.drone_var.get())
+        operators = self.operators.find_by_name(self.operator_var.get())
+        if len(drones) != 1 or len(operators) != 1:
+            # Names are ambiguous - the allocation cannot be checked
+            self.checked = False
+            if len(drones) > 1:
+                self.errors_text.insert(tk.END, "More than one drone has this name\n")
+            if len(operators) > 1:
+                self.errors_text.insert(tk.END, "More than one operator has this name\n")
+            return
+
+        self.action = self.drones.allocate(drones[0], operators[0])
         for message in self.action.messages:
             self.errors_text.insert(tk.END, message+'\n')
         
         if self.action.messages == []:
             self.errors_text.insert(tk.END, "No Errors")
 
+    @timed('allocation_window.allocate')
     def allocate(self):
         if not self.checked:
             self.errors_text.insert(tk.END, "The allocation has not been checked.\n")
         else:
-            operator = self.action.commit()
-            self.operators.save(operator)
+            self.operators.commit_allocation(self.action)
         self.root.destroy()
 
     def close(self):
@@ -172,6 +524,8 @@ class MapWindow(object):
         # Add a variable to hold the stores
         self.drones = parent.drones
         self.maps = parent.maps
+        self.tracker = parent.tracker
+        self.map_images = parent.map_images
 
         # Initialise the new top-level window (modal dialog)
         self._parent = parent.root
@@ -179,12 +533,18 @@ class MapWindow(object):
         self.root.title("Map Viewer")
         self.root.transient(parent.root)
         self.root.grab_set()
+        self.root.protocol('WM_DELETE_WINDOW', self.close)
 
         # Initialise the top level frame
         self.frame = tk.Frame(self.root)
         self.frame.pack(side=tk.TOP, fill=tk.BOTH,
                         expand=tk.Y, padx=10, pady=10)
 
+        # Live and replay state, which drawing the drones checks
+        self._subscription = None
+        self._replaying = False
+        self._playing = False
+
         self.draw_map()
         self.draw_drones()
         
@@ -198,47 +558,231 @@ class MapWindow(object):
                                    command=self.refresh_drones, width=20, padx=5, pady=5)
         refresh_button.grid(in_=self.frame, row=4, column=0, sticky=tk.E)
 
+        # Live mode - the tracker publishes the positions from a worker thread
+        self.live_var = tk.IntVar(self.frame)
+        live_check = tk.Checkbutton(self.frame, text="Live", variable=self.live_var,
+                                    command=self.toggle_live)
+        live_check.grid(in_=self.frame, row=4, column=0, sticky=tk.W)
+
+        # Replay controls - the slider picks a time in the recorded history
+        replay_frame = tk.Frame(self.frame)
+        replay_frame.grid(in_=self.frame, row=6, column=0, sticky=tk.EW)
+        self.replay_var = tk.IntVar(self.frame)
+        replay_check = tk.Checkbutton(replay_frame, text="Replay", variable=self.replay_var,
+                                      command=self.toggle_replay)
+        replay_check.pack(side=tk.LEFT)
+        self.replay_scale = tk.Scale(replay_frame, orient=tk.HORIZONTAL, length=500,
+                                     resolution=REPLAY_STEP, showvalue=0, state=tk.DISABLED,
+                                     command=self.show_replay_frame)
+        self.replay_scale.pack(side=tk.LEFT, fill=tk.X, expand=tk.Y)
+        self.replay_time_var = tk.StringVar(self.frame)
+        replay_label = tk.Label(replay_frame, textvariable=self.replay_time_var, width=10)
+        replay_label.pack(side=tk.LEFT)
+        self.play_button = tk.Button(replay_frame, text="Play", command=self.play_replay,
+                                     width=8, state=tk.DISABLED)
+        self.play_button.pack(side=tk.LEFT)
+
+        self._app = parent
+        parent.add_change_listener(self._records_changed)
+
     def draw_drones(self):
-        spacing_y = self.img.width() / 100
-        spacing_x = self.img.height() / 100
-        self.current_drones = []
-        for drone in self.drones.list_all():
-            if drone.map.name == self.map_var.get():
-                drone.location.is_valid()
-                x1 = drone.location.position()[0] * spacing_y
-                x2 = x1 + 15
-                y1 = drone.location.position()[1] * spacing_x
-                y2 = y1 + 15
-            
-                if drone.rescue == 1:
-                    self.current_drones.append(self.canvas.create_oval(x1, y1, x2, y2, fill='blue'))
-                else:
-                    self.current_drones.append(self.canvas.create_oval(x1, y1, x2, y2, fill='red'))
+        # Canvas ovals are kept between refreshes and moved rather than recreated
+        self.current_drones = {}
+        self._drone_positions = {}
+        self._update_drone_ovals()
 
+    @timed('map_window.refresh_drones')
     def refresh_drones(self):
-        for i in self.current_drones:
-            self.canvas.delete(i)
-
-        spacing_y = self.img.width() / 100
-        spacing_x = self.img.height() / 100
-
-        for drone in self.drones.list_all():
-            if drone.map.name == self.map_var.get():
-                drone.location.is_valid()
-                x1 = drone.location.position()[0] * spacing_y
-                x2 = x1 + 15
-                y1 = drone.location.position()[1] * spacing_x
-                y2 = y1 + 15
+        # Move the whole fleet on before drawing the new positions
+        self.tracker.step()
+        self._update_drone_ovals()
+
+    def clear_drones(self):
+        """ Removes every drone oval from the canvas. """
+        for item in self.current_drones.itervalues():
+            self.canvas.delete(item)
+        self.current_drones = {}
+        self._drone_positions = {}
+
+    @timed('map_window.update_drone_ovals')
+    def _update_drone_ovals(self):
+        """ Moves, adds and removes ovals so they match the drones on the selected map. """
+        if self._replaying:
+            return
+        map_ = self.maps.get(self.map_var.get())
+        drone_ids = self.tracker.drones_on_map(map_)
+        drones = [self.drones.get(id) for id in drone_ids]
+        self._draw_ovals(drones, self.tracker.retrieve_many(map_, drones).positions())
+
+    def _draw_ovals(self, drones, positions):
+        """ Moves, adds and removes ovals to show drones at (n, 2) positions on the map. """
+        positions = positions * (self.img.width() / 100, self.img.height() / 100)
+
+        # Remove the drones that have left the map
+        on_map = set(drone.id for drone in drones)
+        for id in [id for id in self.current_drones if not id in on_map]:
+            self.canvas.delete(self.current_drones.pop(id))
+            del self._drone_positions[id]
+
+        for drone, position in zip(drones, positions.tolist()):
+            x1, y1 = position
+            x2 = x1 + 15
+            y2 = y1 + 15
+            item = self.current_drones.get(drone.id)
+            if item is None:
                 if drone.rescue == 1:
-                    self.current_drones.append(self.canvas.create_oval(x1, y1, x2, y2, fill='blue'))
+                    item = self.canvas.create_oval(x1, y1, x2, y2, fill='blue')
                 else:
-                    self.current_drones.append(self.canvas.create_oval(x1, y1, x2, y2, fill='red'))
+                    item = self.canvas.create_oval(x1, y1, x2, y2, fill='red')
+                self.current_drones[drone.id] = item
+            elif self._drone_positions[drone.id] != position:
+                self.canvas.coords(item, x1, y1, x2, y2)
+            self._drone_positions[drone.id] = position
+
+    def _records_changed(self, changed, removed):
+        """ Redraws the drones that other instances have changed, added or removed. """
+        for kind, id in changed + removed:
+            if kind == 'drone' and id in self.current_drones:
+                # Drawn again below, in case the drone has changed map or type
+                self.canvas.delete(self.current_drones.pop(id))
+                del self._drone_positions[id]
+        self._update_drone_ovals()
+
+    def toggle_replay(self):
+        """ Switches between the live drone positions and replaying their history. """
+        if self.replay_var.get():
+            span = self.tracker.history.time_range()
+            if span is None:
+                self.replay_var.set(0)
+                return
+            self._start_replay(span)
+        else:
+            self._replaying = False
+            self._playing = False
+            self.replay_scale.config(state=tk.DISABLED)
+            self.play_button.config(state=tk.DISABLED, text="Play")
+            self.replay_time_var.set('')
+            self._update_drone_ovals()
+
+    def _start_replay(self, span):
+        """ Loads the trajectories of the drones on the selected map for a replay. """
+        self._replaying = True
+        self._replay_start = span[0]
+        map_ = self.maps.get(self.map_var.get())
+        self._trajectories = {}
+        for id in self.tracker.drones_on_map(map_):
+            self._trajectories[id] = self.tracker.history.trajectory(id, span[0], span[1])
+        self.replay_scale.config(state=tk.NORMAL, from_=0, to=span[1] - span[0])
+        self.play_button.config(state=tk.NORMAL)
+        self.replay_scale.set(0)
+        self.show_replay_frame()
+
+    def show_replay_frame(self, *args):
+        """ Shows where each drone was at the time selected on the replay slider. """
+        if not self._replaying:
+            return
+        offset = float(self.replay_scale.get())
+        when = self._replay_start + offset
+        drones = []
+        positions = []
+        for id, (times, x, y) in self._trajectories.iteritems():
+            # The last position recorded at or before the replay time
+            index = np.searchsorted(times, when, side='right') - 1
+            if index >= 0:
+                drones.append(self.drones.get(id))
+                positions.append((x[index], y[index]))
+        self._draw_ovals(drones, np.array(positions, dtype=np.float32).reshape(-1, 2))
+        self.replay_time_var.set('+%d:%02d' % divmod(int(offset), 60))
+
+    def play_replay(self):
+        """ Starts or pauses playing the replay. """
+        self._playing = not self._playing
+        self.play_button.config(text="Pause" if self._playing else "Play")
+        if self._playing:
+            self.root.after(REPLAY_INTERVAL, self._advance_replay)
+
+    def _advance_replay(self):
+        if not self._playing or not self._replaying:
+            return
+        offset = float(self.replay_scale.get()) + REPLAY_STEP
+        if offset > float(self.replay_scale.cget('to')):
+            self.play_replay()
+            return
+        self.replay_scale.set(offset)
+        self.root.after(REPLAY_INTERVAL, self._advance_replay)
+
+    def toggle_live(self):
+        """ Starts or stops redrawing the drones whenever the tracker publishes new positions. """
+        if self.live_var.get():
+            self._subscribe()
+        else:
+            self._unsubscribe()
+
+    def _subscribe(self):
+        map_ = self.maps.get(self.map_var.get())
+        self._subscription = self.tracker.subscribe(map_, LIVE_RATE)
+        self.root.after(int(1000 / LIVE_RATE), self._show_live_positions, self._subscription)
+
+    def _unsubscribe(self):
+        if self._subscription is not None:
+            self.tracker.unsubscribe(self._subscription)
+            self._subscription = None
+
+    def _show_live_positions(self, subscription):
+        # Each subscription has its own loop, which stops once it is replaced
+        if subscription is not self._subscription:
+            return
+        batch = subscription.take()
+        # Replays take over the canvas until they are switched off
+        if batch is not None and not self._replaying:
+            drones = []
+            rows = []
+            for row, id in enumerate(batch.drone_ids.tolist()):
+                drone = self.drones.get(id)
+                if drone is not None:
+                    drones.append(drone)
+                    rows.append(row)
+            self._draw_ovals(drones, batch.positions[rows])
+        self.root.after(int(1000 / LIVE_RATE), self._show_live_positions, subscription)
 
     def change_map(self, *args):
-        self.img = tk.PhotoImage(file=self.maps.get(self.map_var.get()).filepath)
-        self.canvas.create_image(0, 0, image=self.img, anchor=tk.NW)
-        self.canvas.config(scrollregion=(0,0,self.img.width(),self.img.height()))
+        if self._replaying:
+            # Replays are of the drones on one map
+            self.replay_var.set(0)
+            self.toggle_replay()
+        if self._subscription is not None:
+            # Subscriptions are to the drones on one map
+            self._unsubscribe()
+            self._subscribe()
+        self.show_map()
+        self.clear_drones()
         self.draw_drones()
+
+    def show_map(self):
+        """ Shows the selected map on the canvas. """
+        self.canvas.delete('map')
+        self.img = self.map_images.load_map(self.maps.get(self.map_var.get()).filepath)
+        self.canvas.config(scrollregion=(0,0,self.img.width(),self.img.height()))
+        if isinstance(self.img, TiledMap):
+            self.draw_visible_tiles()
+        else:
+            self.canvas.create_image(0, 0, image=self.img, anchor=tk.NW, tags='map')
+            self.canvas.tag_lower('map')
+
+    def draw_visible_tiles(self):
+        """ Draws the map tiles in the visible part of the canvas. """
+        x0 = self.canvas.canvasx(0)
+        y0 = self.canvas.canvasy(0)
+        # The canvas reports a width of 1 until it is first displayed
+        x1 = x0 + max(self.canvas.winfo_width(), int(self.canvas['width']))
+        y1 = y0 + max(self.canvas.winfo_height(), int(self.canvas['height']))
+        self.img.draw(self.canvas, x0, y0, x1, y1, 'map')
+
+    def _scrolled(self, scrollbar, first, last):
+        """ Updates a scrollbar and draws any map tiles that have come into view. """
+        scrollbar.set(first, last)
+        if isinstance(self.img, TiledMap):
+            self.draw_visible_tiles()
     
     def draw_map(self):
         self.img = None
@@ -252,9 +796,7 @@ class MapWindow(object):
         self.map_var.trace("w", self.change_map)
         map_option = tk.OptionMenu(self.frame, self.map_var, *map_names)
 
-        self.img = tk.PhotoImage(file=self.maps.get(map_names[0]).filepath)
-
-        self.canvas = tk.Canvas(self.frame, width=800, height=500, bg='black', scrollregion=(0,0,self.img.width(),self.img.height()))
+        self.canvas = tk.Canvas(self.frame, width=800, height=500, bg='black')
 
         hbar=tk.Scrollbar(self.frame,orient=tk.HORIZONTAL)
         hbar.grid(in_=self.frame,row=3,column=0,sticky=tk.EW)
@@ -265,24 +807,31 @@ class MapWindow(object):
         vbar.config(command=self.canvas.yview)
         
         self.canvas.config(width=800,height=500)
-        self.canvas.config(xscrollcommand=hbar.set, yscrollcommand=vbar.set)
+        self.canvas.config(xscrollcommand=lambda first, last: self._scrolled(hbar, first, last),
+                           yscrollcommand=lambda first, last: self._scrolled(vbar, first, last))
 
         self.canvas.grid(in_=self.frame, row=2, column=0, sticky=tk.W)
         map_option.grid(in_=self.frame, row=1, column=0, sticky=tk.W)
 
-        self.canvas.create_image(0, 0, image=self.img, anchor=tk.NW)
+        self.show_map()
     
     def close(self):
         """ Closes the list window. """
+        self._app.remove_change_listener(self._records_changed)
+        self._unsubscribe()
         self.root.destroy()
 
 class ListWindow(object):
     """ Base list window. """
 
+    # The kind of record listed - used to look up the save state of each row
+    record_kind = None
+
     def __init__(self, parent, title):
         # Add a variable to hold the stores
         self.drones = parent.drones
         self.operators = parent.operators
+        self.unit_of_work = parent.unit_of_work
 
         # Initialise the new top-level window (modal dialog)
         self._parent = parent.root
@@ -290,12 +839,17 @@ class ListWindow(object):
         self.root.title(title)
         self.root.transient(parent.root)
         self.root.grab_set()
+        self.root.protocol('WM_DELETE_WINDOW', self.close)
 
         # Initialise the top level frame
         self.frame = tk.Frame(self.root)
         self.frame.pack(side=tk.TOP, fill=tk.BOTH,
                         expand=tk.Y, padx=10, pady=10)
 
+        self.unit_of_work.add_listener(self._save_state_changed)
+        self._app = parent
+        parent.add_change_listener(self._records_changed)
+
     def add_list(self, columns, edit_action):
         # Add the list
         self.tree = ttk.Treeview(self.frame, columns=columns, show='headings')
@@ -305,9 +859,12 @@ class ListWindow(object):
                             command=self.tree.yview)
         xsb = ttk.Scrollbar(self.frame, orient=tk.HORIZONTAL,
                             command=self.tree.xview)
-        self.tree['yscroll'] = ysb.set
+        self._ysb = ysb
+        self.tree['yscroll'] = self._scrolled
         self.tree['xscroll'] = xsb.set
         self.tree.bind("<Double-1>", edit_action)
+        self.tree.tag_configure('pending', foreground='grey')
+        self.tree.tag_configure('failed', foreground='red')
 
         # Add tree and scrollbars to frame
         self.tree.grid(in_=self.frame, row=0, column=0, sticky=tk.NSEW)
@@ -318,14 +875,114 @@ class ListWindow(object):
         self.frame.rowconfigure(0, weight=1)
         self.frame.columnconfigure(0, weight=1)
 
+    @timed('list_window.populate_data')
+    def populate_data(self):
+        """ Populates the view with the first page of records, in ID order - the rest are added
+        as the user scrolls. """
+        self.tree.delete(*self.tree.get_children())
+        self._record_ids = self.list_record_ids()
+        self._listed_ids = set(self._record_ids)
+        self._next_record = 0
+        self._load_page()
+
+    def add_item(self, id):
+        """ Adds a new record to the view, in ID order. """
+        index = bisect_left(self._record_ids, id)
+        self._record_ids.insert(index, id)
+        self._listed_ids.add(id)
+        # Show it now if it falls among the loaded rows, or every other record is shown
+        if index < self._next_record or self._next_record == len(self._record_ids) - 1:
+            self.tree.insert('', index, iid=str(id), values=self.row_values(self.get_record(id)),
+                             tags=self._row_tags(id))
+            self._next_record += 1
+
+    def remove_item(self, id):
+        """ Removes a record from the view. """
+        if id in self._listed_ids:
+            index = bisect_left(self._record_ids, id)
+            del self._record_ids[index]
+            self._listed_ids.discard(id)
+            if index < self._next_record:
+                self._next_record -= 1
+                self.tree.delete(str(id))
+
+    def update_item(self, id):
+        """ Refreshes the row for a record, if it has been loaded. """
+        iid = str(id)
+        if self.tree.exists(iid):
+            self.tree.item(iid, values=self.row_values(self.get_record(id)),
+                           tags=self._row_tags(id))
+
+    def selected_id(self):
+        """ Returns the ID of the record in the focused row. """
+        return int(self.tree.focus())
+
+    def list_record_ids(self):
+        """ Lists the IDs of the records to show - this needs to be overriden in inherited classes. """
+        return []
+
+    def get_record(self, id):
+        """ Retrieves a record by its ID - this needs to be overriden in inherited classes. """
+        return None
+
+    def row_values(self, record):
+        """ Returns the values displayed for a record - this needs to be overriden in inherited
+        classes. """
+        return ()
+
+    def _load_page(self):
+        """ Adds the next page of records to the view. """
+        page = self._record_ids[self._next_record:self._next_record + LIST_PAGE_SIZE]
+        for id in page:
+            self.tree.insert('', 'end', iid=str(id), values=self.row_values(self.get_record(id)),
+                             tags=self._row_tags(id))
+        self._next_record += len(page)
+
+    def _scrolled(self, first, last):
+        """ Updates the scrollbar and loads more rows when the end of the list comes into view.
+        The rows are loaded on demand rather than virtualised, so the scrollbar only covers the
+        rows loaded so far and the list grows as the user scrolls towards its end. """
+        self._ysb.set(first, last)
+        if float(last) > 0.9 and self._next_record < len(self._record_ids):
+            self._load_page()
+
+    def _row_tags(self, id):
+        """ Returns the tags showing whether a record is still being saved or failed to save. """
+        state = self.unit_of_work.state(self.record_kind, id)
+        if state is None:
+            return ()
+        return (state,)
+
+    def _save_state_changed(self, keys):
+        """ Updates the rows of the records whose save state has changed. """
+        for kind, id in keys:
+            if kind == self.record_kind and self.tree.exists(str(id)):
+                self.tree.item(str(id), tags=self._row_tags(id))
+
+    def _records_changed(self, changed, removed):
+        """ Shows the records that other instances have changed, added or removed. """
+        for kind, id in removed:
+            if kind == self.record_kind:
+                self.remove_item(id)
+        for kind, id in changed:
+            if kind == self.record_kind:
+                if id in self._listed_ids:
+                    self.update_item(id)
+                else:
+                    self.add_item(id)
+
     def close(self):
         """ Closes the list window. """
+        self.unit_of_work.remove_listener(self._save_state_changed)
+        self._app.remove_change_listener(self._records_changed)
         self.root.destroy()
 
 
 class DroneListWindow(ListWindow):
     """ Window to display a list of drones. """
 
+    record_kind = 'drone'
+
     def __init__(self, parent):
         super(DroneListWindow, self).__init__(parent, 'Drones')
 
@@ -342,15 +999,18 @@ class DroneListWindow(ListWindow):
                                 command=self.close, width=20, padx=5, pady=5)
         exit_button.grid(in_=self.frame, row=3, column=0, sticky=tk.E)
 
-    def populate_data(self):
-        """ Populates the data in the view. """
-        self.tree.delete(*self.tree.get_children())
-        for drone in self.drones.list_all():
-            self.tree.insert('', 'end', values=(drone.id, 
-                                                drone.name, 
-                                                drone.class_type, 
-                                                drone.rescue, 
-                                                drone.operator))
+    def list_record_ids(self):
+        return self.drones.list_ids()
+
+    def get_record(self, id):
+        return self.drones.get(id)
+
+    def row_values(self, drone):
+        return (drone.id, 
+                drone.name, 
+                drone.class_type, 
+                drone.rescue, 
+                drone.operator)
 
     def add_drone(self):
         """ Starts a new drone and displays it in the list. """
@@ -363,13 +1023,12 @@ class DroneListWindow(ListWindow):
     def _save_new_drone(self, drone):
         """ Saves the drone in the store and updates the list. """
         self.drones.add(drone)
-        self.populate_data()
+        self.add_item(drone.id)
 
     def edit_drone(self, event):
         """ Retrieves the drone and shows it in the editor. """
         # Retrieve the identifer of the drone
-        item = self.tree.item(self.tree.focus())
-        item_id = item['values'][0]
+        item_id = self.selected_id()
 
         # Load the drone from the store
         drone = self.drones.get(item_id)
@@ -380,7 +1039,7 @@ class DroneListWindow(ListWindow):
     def _update_drone(self, drone):
         """ Saves the new details of the drone. """
         self.drones.save(drone)
-        self.populate_data()
+        self.update_item(drone.id)
 
     def view_drone(self, drone, save_action):
         """ Displays the drone editor. """
@@ -390,6 +1049,8 @@ class DroneListWindow(ListWindow):
 class OperatorListWindow(ListWindow):
     """ Window to display a list of operators. """
 
+    record_kind = 'operator'
+
     def __init__(self, parent):
         super(OperatorListWindow, self).__init__(parent, 'Operators')
 
@@ -406,27 +1067,30 @@ class OperatorListWindow(ListWindow):
                                 command=self.close, width=20, padx=5, pady=5)
         exit_button.grid(in_=self.frame, row=3, column=0, sticky=tk.E)
 
-    def populate_data(self):
-        """ Populates the data in the view. """
-        self.tree.delete(*self.tree.get_children())
-        for operator in self.operators.list_all():
-            if operator.drone == None:
-                operator_drone = "<None>"
-            else:
-                operator_drone = str(operator.drone) + ". " + self.drones.get(operator.drone).name
-            if operator.drone_license == 1:
-                operator_drone_license = "One"
-            else:
-                operator_drone_license = "Two"
-            if operator.rescue_endorsement == 1:
-                operator_rescue_endorsement = "Yes"
-            else:
-                operator_rescue_endorsement = "No"
-            self.tree.insert('', 'end', values=(operator.first_name + ' ' + operator.family_name, 
-                                                operator_drone_license, 
-                                                operator_rescue_endorsement, 
-                                                operator.operations, 
-                                                operator_drone))
+    def list_record_ids(self):
+        return self.operators.list_ids()
+
+    def get_record(self, id):
+        return self.operators.get(id)
+
+    def row_values(self, operator):
+        if operator.drone == None:
+            operator_drone = "<None>"
+        else:
+            operator_drone = str(operator.drone) + ". " + self.drones.get(operator.drone).name
+        if operator.drone_license == 1:
+            operator_drone_license = "One"
+        else:
+            operator_drone_license = "Two"
+        if operator.rescue_endorsement == 1:
+            operator_rescue_endorsement = "Yes"
+        else:
+            operator_rescue_endorsement = "No"
+        return (operator.full_name(), 
+                operator_drone_license, 
+                operator_rescue_endorsement, 
+                operator.operations, 
+                operator_drone)
 
     def add_operator(self):
         """ Starts a new operator and displays it in the list. """
@@ -439,13 +1103,12 @@ class OperatorListWindow(ListWindow):
     def _save_new_operator(self, operator):
         """ Saves the drone in the store and updates the list. """
         self.operators._add(operator)
-        self.populate_data()
+        self.add_item(operator.id)
 
     def edit_operator(self, event):
         """ Retrieves the drone and shows it in the editor. """
         # Retrieve the identifer of the operator
-        item = self.tree.item(self.tree.focus())
-        item_id = item['values'][0]
+        item_id = self.selected_id()
 
         # Load the operator from the store
         operator = self.operators.get(item_id)
@@ -456,7 +1119,7 @@ class OperatorListWindow(ListWindow):
     def _update_operator(self, operator):
         """ Saves the new details of the operator. """
         self.operators.save(operator)
-        self.populate_data()
+        self.update_item(operator.id)
 
     def view_operator(self, operator, save_action):
         """ Displays the operator editor. """
@@ -547,7 +1210,7 @@ class DroneEditorWindow(EditorWindow):
 
         location_label = tk.Label(self.frame, text="Location:")
         location_txt_box = tk.Text(self.frame, height=1, width=20)
-        if self._drone.location.is_valid():
+        if self._drone.location is not None and self._drone.location.is_valid():
             position = str(self._drone.location.position())[0:-4] +')'
             location_txt_box.insert(tk.END, position)
         else:
@@ -655,11 +1318,16 @@ class OperatorEditorWindow(EditorWindow):
         self._save_action(self._operator)
 
 if __name__ == '__main__':
-    conn = mysql.connector.connect(user='root',
-                                   password='password',
-                                   host='127.0.0.1',
-                                   database='dalsys',
-                                   charset='utf8')
-    app = Application(conn)
+    # The storage backend is chosen in dalsys.ini next to this file, or the file given
+    if len(sys.argv) > 1:
+        config_path = sys.argv[1]
+    else:
+        config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dalsys.ini')
+    backend = backend_from_config(config_path)
+    app = Application(backend, show_timings=show_timings_from_config(config_path),
+                      snapshot_path=local_path_from_config(config_path, 'snapshot'),
+                      history_path=local_path_from_config(config_path, 'history'),
+                      telemetry_port=telemetry_port_from_config(config_path),
+                      metrics_path=local_path_from_config(config_path, 'metrics'))
     app.main_loop()
-    conn.close()
+    backend.close()
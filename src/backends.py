@@ -0,0 +1,612 @@
+import os
+import sqlite3
+import threading
+from ConfigParser import SafeConfigParser
+
+from metrics import InstrumentedCursor, metrics, timed
+
+# Columns of each table, in the order the stores expect the rows
+DRONE_COLUMNS = ('drone_id', 'name', 'class_type', 'rescue', 'operator_id', 'map_id')
+OPERATOR_COLUMNS = ('operator_id', 'first_name', 'family_name', 'date_of_birth', 'drone_license',
+                    'rescue_endorsement', 'operations', 'drone_id')
+MAP_COLUMNS = ('name', 'filepath')
+
+# Every write is stamped with the next value of a version counter, so readers can fetch just the
+# rows changed since a version they have already seen
+VERSION_COLUMN = 'row_version'
+
+# Number of rows fetched from the database at a time when the stores are loaded
+LOAD_BATCH_SIZE = 1000
+
+# Number of IDs reserved from the database at a time for new records
+ID_BLOCK_SIZE = 100
+
+# Column holding the ID of each table whose new records are given IDs from the database
+ID_COLUMNS = {'drone': DRONE_COLUMNS[0], 'operator': OPERATOR_COLUMNS[0]}
+
+
+class StorageBackend(object):
+    """ Defines the storage backend interface used by the stores. """
+
+    def connect(self):
+        """ Returns a new backend onto the same data with its own connection, for use on
+        another thread. """
+        raise NotImplementedError()
+
+    def close(self):
+        """ Closes the connection. """
+        pass
+
+    def identity(self):
+        """ Returns a string naming the database this backend stores the records in, or None if
+        the records are not kept between runs. """
+        return None
+
+    def current_version(self):
+        """ Returns the version of the latest write. """
+        raise NotImplementedError()
+
+    def load_changes(self, since):
+        """ Lists the changes written after a version, as (version, drone rows, operator rows,
+        map rows, removed drone IDs). The rows are in the same column order as the loads. """
+        raise NotImplementedError()
+
+    def load_drones(self, batch_size):
+        """ Lists the drone rows in batches, with the columns in DRONE_COLUMNS order. """
+        raise NotImplementedError()
+
+    def load_operators(self, batch_size):
+        """ Lists the operator rows in batches, with the columns in OPERATOR_COLUMNS order. """
+        raise NotImplementedError()
+
+    def load_maps(self, batch_size):
+        """ Lists the map rows in batches, with the columns in MAP_COLUMNS order. """
+        raise NotImplementedError()
+
+    def reserve_ids(self, table, count):
+        """ Reserves count IDs for new records of the 'drone' or 'operator' table, returning the
+        first. IDs are never reserved twice, even by other connections to the same database. """
+        raise NotImplementedError()
+
+    def write(self, removed_drones, drone_rows, operator_rows, drone_updates=(),
+              operator_updates=(), drone_inserts=(), operator_inserts=()):
+        """ Deletes the removed drones, inserts or replaces the drone and operator rows, applies
+        the updates and inserts the rows of new records, all in a single transaction. Each
+        update is an (ID, column names, values) triple that sets only those columns of an
+        existing row. Inserting a row whose ID is already in use fails the whole write. """
+        raise NotImplementedError()
+
+    def write_maps(self, map_rows):
+        """ Inserts or replaces map rows, with the columns in MAP_COLUMNS order. """
+        raise NotImplementedError()
+
+
+class IdAllocator(object):
+    """ Hands out the IDs of new records of a table. The IDs are reserved from the backend a
+    block at a time, so instances sharing a database never give two records the same ID. """
+
+    def __init__(self, backend, table, block_size=ID_BLOCK_SIZE):
+        self._backend = backend
+        self._table = table
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+
+    def next_id(self):
+        """ Returns the ID for a new record. """
+        if self._next == self._end:
+            self._next = self._backend.reserve_ids(self._table, self.block_size)
+            self._end = self._next + self.block_size
+        self._next += 1
+        return self._next - 1
+
+
+class SQLBackend(StorageBackend):
+    """ Base for the backends that store the records in an SQL database.
+
+    Every statement comes from a catalogue of parameterised queries built once for the
+    connection. Each catalogue statement runs on a cursor of its own, kept for as long as the
+    connection is open, so drivers that prepare statements on the server only prepare each one
+    once. """
+
+    # Parameter placeholder used by the database driver
+    placeholder = '%s'
+
+    # Function returning the larger of two values
+    greatest = 'GREATEST'
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._statements = self.statements()
+        # Catalogue names of the statements, so the metrics can be recorded under them
+        self._statement_names = dict((sql, name) for name, sql in self._statements.iteritems())
+        # Catalogue name -> the cursor that statement runs on
+        self._cursors = {}
+        self._batch_cursor = None
+
+    def close(self):
+        for cursor in self._cursors.values() + [self._batch_cursor]:
+            if cursor is not None:
+                cursor.close()
+        self._conn.close()
+
+    def statements(self):
+        """ Returns the catalogue of statements used by the backend, keyed by name. """
+        p = self.placeholder
+        statements = {
+            'current_version': "SELECT version FROM sync_version",
+            'next_version': "UPDATE sync_version SET version = version + 1",
+            # Drones added again after being removed are in the drone rows instead
+            'removed_drones_since': "SELECT drone_id FROM removed_drone WHERE row_version > %s "
+                                    "AND drone_id NOT IN (SELECT drone_id FROM drone)" % p,
+            'delete_drone': "DELETE FROM drone WHERE drone_id = %s" % p,
+            'upsert_removed_drone': self.upsert_sql('removed_drone',
+                                                    ('drone_id', VERSION_COLUMN)),
+            'reserved_ids': "SELECT next_id FROM id_block WHERE table_name = %s" % p,
+        }
+        for table in ID_COLUMNS:
+            statements['reserve_%s_ids' % table] = self.reserve_sql(table)
+        for table, columns in (('drone', DRONE_COLUMNS), ('operator', OPERATOR_COLUMNS),
+                               ('map', MAP_COLUMNS)):
+            select = "SELECT %s FROM %s" % (', '.join(columns), table)
+            statements['select_' + table] = select
+            statements['select_%s_since' % table] = "%s WHERE %s > %s" % (select, VERSION_COLUMN, p)
+            statements['upsert_' + table] = self.upsert_sql(table, columns + (VERSION_COLUMN,))
+            statements['insert_' + table] = "INSERT INTO %s (%s) VALUES (%s)" % (
+                table, ', '.join(columns + (VERSION_COLUMN,)),
+                self._values(columns + (VERSION_COLUMN,)))
+        return statements
+
+    def load_drones(self, batch_size):
+        return self._select('select_drone', batch_size)
+
+    def load_operators(self, batch_size):
+        return self._select('select_operator', batch_size)
+
+    def load_maps(self, batch_size):
+        return self._select('select_map', batch_size)
+
+    def current_version(self):
+        # End any read transaction left open, so the latest writes are seen
+        self._commit()
+        return self._execute('current_version').fetchall()[0][0]
+
+    @timed('db.load_changes')
+    def load_changes(self, since):
+        version = self.current_version()
+        param = (since,)
+        drones = self._execute('select_drone_since', param).fetchall()
+        operators = self._execute('select_operator_since', param).fetchall()
+        maps = self._execute('select_map_since', param).fetchall()
+        removed = [row[0] for row in self._execute('removed_drones_since', param).fetchall()]
+        return version, drones, operators, maps, removed
+
+    @timed('db.reserve_ids')
+    def reserve_ids(self, table, count):
+        try:
+            last = self._reserve_ids(table, count)
+            self._commit()
+        except Exception:
+            self._rollback()
+            raise
+        return last - count
+
+    def _reserve_ids(self, table, count):
+        """ Moves the ID block counter of a table on by count, returning its new value. """
+        self._execute('reserve_%s_ids' % table, (count,))
+        return self._execute('reserved_ids', (table,)).fetchall()[0][0]
+
+    @timed('db.write', rows=lambda self, *batch: sum(len(rows) for rows in batch))
+    def write(self, removed_drones, drone_rows, operator_rows, drone_updates=(),
+              operator_updates=(), drone_inserts=(), operator_inserts=()):
+        try:
+            version = self._next_version()
+            if removed_drones:
+                self._execute_many('delete_drone', [(drone_id,) for drone_id in removed_drones])
+                self._insert_many('upsert_removed_drone',
+                                  [(drone_id, version) for drone_id in removed_drones])
+            # New records are plain inserts, so a clash of IDs fails rather than replacing a row
+            if drone_inserts:
+                self._insert_many('insert_drone',
+                                  [tuple(row) + (version,) for row in drone_inserts])
+            if drone_rows:
+                self._insert_many('upsert_drone', [tuple(row) + (version,) for row in drone_rows])
+            if operator_inserts:
+                self._insert_many('insert_operator',
+                                  [tuple(row) + (version,) for row in operator_inserts])
+            if operator_rows:
+                self._insert_many('upsert_operator',
+                                  [tuple(row) + (version,) for row in operator_rows])
+            self._update('drone', DRONE_COLUMNS[0], drone_updates, version)
+            self._update('operator', OPERATOR_COLUMNS[0], operator_updates, version)
+            self._commit()
+        except Exception:
+            self._rollback()
+            raise
+
+    def write_maps(self, map_rows):
+        try:
+            version = self._next_version()
+            self._insert_many('upsert_map', [tuple(row) + (version,) for row in map_rows])
+            self._commit()
+        except Exception:
+            self._rollback()
+            raise
+
+    def _update(self, table, key, updates, version):
+        """ Runs the updates of a table, one statement for each set of columns changed. """
+        groups = {}
+        for id, columns, values in updates:
+            groups.setdefault(columns, []).append(tuple(values) + (version, id))
+        for columns, rows in groups.iteritems():
+            self._execute_many(self._update_statement(table, key, columns), rows)
+
+    def _update_statement(self, table, key, columns):
+        """ Returns the catalogue name of the statement that sets some columns of a row, adding
+        it the first time those columns are updated. """
+        name = 'update_%s_%s' % (table, '_'.join(columns))
+        if not name in self._statements:
+            assignments = ', '.join('%s = %s' % (column, self.placeholder)
+                                    for column in columns + (VERSION_COLUMN,))
+            sql = "UPDATE %s SET %s WHERE %s = %s" % (table, assignments, key, self.placeholder)
+            self._statements[name] = sql
+            self._statement_names[sql] = name
+        return name
+
+    def _cursor(self, name):
+        """ Returns the cursor a catalogue statement runs on, creating it on first use. """
+        cursor = self._cursors.get(name)
+        if cursor is None:
+            cursor = self._cursors[name] = self.prepared_cursor()
+        return self._instrument(cursor)
+
+    def _execute(self, name, params=()):
+        """ Runs a catalogue statement on its cursor and returns the cursor. """
+        cursor = self._cursor(name)
+        cursor.execute(self._statements[name], params)
+        return cursor
+
+    def _execute_many(self, name, rows):
+        """ Runs a catalogue statement on its cursor once for each row of parameters. """
+        self._cursor(name).executemany(self._statements[name], rows)
+
+    def _insert_many(self, name, rows):
+        """ Runs a catalogue insert for many rows on the batch cursor. """
+        if self._batch_cursor is None:
+            self._batch_cursor = self.batch_cursor()
+        self._instrument(self._batch_cursor).executemany(self._statements[name], rows)
+
+    def prepared_cursor(self):
+        """ Returns a cursor for one catalogue statement, which keeps it prepared between runs.
+        Drivers such as sqlite3 already keep the compiled statements of a connection, keyed by
+        their text, so any cursor will do for them. """
+        return self._conn.cursor()
+
+    def batch_cursor(self):
+        """ Returns a cursor for inserting many rows of parameters at once. """
+        return self._conn.cursor()
+
+    def _instrument(self, cursor):
+        """ Wraps a cursor so it records its statements while metrics are enabled. """
+        if metrics.enabled:
+            return InstrumentedCursor(cursor, names=self._statement_names)
+        return cursor
+
+    def _commit(self):
+        with metrics.timer('sql.commit'):
+            self._conn.commit()
+
+    def _rollback(self):
+        with metrics.timer('sql.rollback'):
+            self._conn.rollback()
+
+    def _next_version(self):
+        """ Takes the next version for a write. The counter row stays locked until the write
+        commits, so writes become visible in version order. """
+        self._execute('next_version')
+        return self._execute('current_version').fetchone()[0]
+
+    def upsert_sql(self, table, columns):
+        """ Returns the statement that inserts a row or replaces the existing row with its key. """
+        raise NotImplementedError()
+
+    def reserve_sql(self, table):
+        """ Returns the statement that moves the ID block counter of a table on by a count. """
+        return "UPDATE id_block SET next_id = %s WHERE table_name = '%s'" % (
+            self._next_id_sql(table), table)
+
+    def _next_id_sql(self, table):
+        # IDs written before the counter existed are skipped over as well
+        return "%s(next_id, (SELECT COALESCE(MAX(%s), 0) + 1 FROM %s)) + %s" % (
+            self.greatest, ID_COLUMNS[table], table, self.placeholder)
+
+    def _select(self, name, batch_size):
+        # Loads get a cursor of their own, as they fetch in batches while other statements run
+        cursor = self._instrument(self._conn.cursor())
+        try:
+            cursor.execute(self._statements[name])
+            rows = cursor.fetchmany(batch_size)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(batch_size)
+        finally:
+            cursor.close()
+
+    def _values(self, columns):
+        return ', '.join([self.placeholder] * len(columns))
+
+
+class MySQLBackend(SQLBackend):
+    """ Stores the records in a MySQL database. """
+
+    def __init__(self, **settings):
+        # Only needed when MySQL is used
+        import mysql.connector
+        if 'port' in settings:
+            settings['port'] = int(settings['port'])
+        self._settings = settings
+        super(MySQLBackend, self).__init__(mysql.connector.connect(**settings))
+
+    def connect(self):
+        return MySQLBackend(**self._settings)
+
+    def identity(self):
+        return 'mysql://%s:%s/%s' % (self._settings.get('host', ''), self._settings.get('port', ''),
+                                     self._settings.get('database', ''))
+
+    def statements(self):
+        statements = super(MySQLBackend, self).statements()
+        # The new version comes back with the update, so taking it is one round trip
+        statements['next_version'] = "UPDATE sync_version SET version = LAST_INSERT_ID(version + 1)"
+        return statements
+
+    def reserve_sql(self, table):
+        # The new counter comes back with the update, as with the version
+        return "UPDATE id_block SET next_id = LAST_INSERT_ID(%s) WHERE table_name = '%s'" % (
+            self._next_id_sql(table), table)
+
+    def _next_version(self):
+        return self._execute('next_version').lastrowid
+
+    def _reserve_ids(self, table, count):
+        return self._execute('reserve_%s_ids' % table, (count,)).lastrowid
+
+    def prepared_cursor(self):
+        # A prepared cursor holds a single statement, which the server parses once - after
+        # that only the parameters are sent
+        return self._conn.cursor(prepared=True)
+
+    def batch_cursor(self):
+        # A plain cursor sends the rows of an INSERT as one multi-row statement, which is
+        # fewer round trips than running a prepared insert once per row
+        return self._conn.cursor()
+
+    def upsert_sql(self, table, columns):
+        updates = ', '.join('%s = VALUES(%s)' % (column, column) for column in columns[1:])
+        return "INSERT INTO %s (%s) VALUES (%s) ON DUPLICATE KEY UPDATE %s" % (
+            table, ', '.join(columns), self._values(columns), updates)
+
+
+class SQLiteBackend(SQLBackend):
+    """ Stores the records in an SQLite database file, creating the tables if needed. """
+
+    placeholder = '?'
+
+    greatest = 'MAX'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS map (
+          map_id INT,
+          name VARCHAR(50),
+          filepath VARCHAR(100),
+          row_version BIGINT DEFAULT 0,
+          PRIMARY KEY(name)
+        );
+        CREATE TABLE IF NOT EXISTS drone (
+          drone_id INT,
+          name VARCHAR(50),
+          class_type INT,
+          rescue BOOLEAN,
+          operator_id INT,
+          map_id VARCHAR(50),
+          row_version BIGINT DEFAULT 0,
+          PRIMARY KEY(drone_id)
+        );
+        CREATE TABLE IF NOT EXISTS operator (
+          operator_id INT,
+          first_name VARCHAR(50),
+          family_name VARCHAR(50),
+          date_of_birth DATE,
+          drone_license INT,
+          rescue_endorsement BOOLEAN,
+          operations INT,
+          drone_id INT,
+          row_version BIGINT DEFAULT 0,
+          PRIMARY KEY(operator_id)
+        );
+        CREATE TABLE IF NOT EXISTS removed_drone (
+          drone_id INT,
+          row_version BIGINT,
+          PRIMARY KEY(drone_id)
+        );
+        CREATE TABLE IF NOT EXISTS sync_version (
+          id INT,
+          version BIGINT,
+          PRIMARY KEY(id)
+        );
+        INSERT OR IGNORE INTO sync_version (id, version) VALUES (1, 0);
+        CREATE TABLE IF NOT EXISTS id_block (
+          table_name VARCHAR(50),
+          next_id BIGINT,
+          PRIMARY KEY(table_name)
+        );
+        INSERT OR IGNORE INTO id_block (table_name, next_id) VALUES ('drone', 1);
+        INSERT OR IGNORE INTO id_block (table_name, next_id) VALUES ('operator', 1);
+        CREATE INDEX IF NOT EXISTS map_version ON map (row_version);
+        CREATE INDEX IF NOT EXISTS drone_version ON drone (row_version);
+        CREATE INDEX IF NOT EXISTS operator_version ON operator (row_version);
+        CREATE INDEX IF NOT EXISTS removed_drone_version ON removed_drone (row_version);
+        """
+
+    def __init__(self, path):
+        self._path = path
+        conn = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+        # Files created before the tables had versions need the column adding first
+        for table in ('map', 'drone', 'operator'):
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)]
+            if columns and not VERSION_COLUMN in columns:
+                conn.execute("ALTER TABLE %s ADD COLUMN %s BIGINT DEFAULT 0" %
+                             (table, VERSION_COLUMN))
+        conn.executescript(self.SCHEMA)
+        super(SQLiteBackend, self).__init__(conn)
+
+    def connect(self):
+        return SQLiteBackend(self._path)
+
+    def identity(self):
+        return 'sqlite://%s' % os.path.abspath(self._path)
+
+    def upsert_sql(self, table, columns):
+        return "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (
+            table, ', '.join(columns), self._values(columns))
+
+
+class MemoryBackend(StorageBackend):
+    """ Keeps the records in memory only - nothing is saved when the application closes. """
+
+    def __init__(self, drones=(), operators=(), maps=(), tables=None, lock=None):
+        if tables is None:
+            # Rows keyed by their first column, shared by every connection to this backend,
+            # with the version each row and removed drone was written at
+            tables = {'drone': dict((row[0], tuple(row)) for row in drones),
+                      'operator': dict((row[0], tuple(row)) for row in operators),
+                      'map': dict((row[0], tuple(row)) for row in maps),
+                      'versions': {'drone': {}, 'operator': {}, 'map': {}},
+                      'removed_drone': {},
+                      'version': 0,
+                      'next_ids': {}}
+        self._tables = tables
+        self._lock = lock or threading.Lock()
+
+    def connect(self):
+        return MemoryBackend(tables=self._tables, lock=self._lock)
+
+    def current_version(self):
+        with self._lock:
+            return self._tables['version']
+
+    @timed('db.load_changes')
+    def load_changes(self, since):
+        with self._lock:
+            changed = {}
+            for table, versions in self._tables['versions'].iteritems():
+                rows = self._tables[table]
+                changed[table] = [rows[key] for key, version in versions.iteritems()
+                                  if version > since and key in rows]
+            removed = [drone_id for drone_id, version in self._tables['removed_drone'].iteritems()
+                       if version > since and not drone_id in self._tables['drone']]
+            return (self._tables['version'], changed['drone'], changed['operator'],
+                    changed['map'], removed)
+
+    def load_drones(self, batch_size):
+        return self._select('drone', batch_size)
+
+    def load_operators(self, batch_size):
+        return self._select('operator', batch_size)
+
+    def load_maps(self, batch_size):
+        return self._select('map', batch_size)
+
+    def reserve_ids(self, table, count):
+        with self._lock:
+            next_ids = self._tables['next_ids']
+            if not table in next_ids:
+                next_ids[table] = max(self._tables[table].keys() or [0]) + 1
+            first = next_ids[table]
+            next_ids[table] += count
+            return first
+
+    @timed('db.write', rows=lambda self, *batch: sum(len(rows) for rows in batch))
+    def write(self, removed_drones, drone_rows, operator_rows, drone_updates=(),
+              operator_updates=(), drone_inserts=(), operator_inserts=()):
+        with self._lock:
+            drones = self._tables['drone']
+            # Checked first, so a failed write changes nothing
+            for table, rows in (('drone', drone_inserts), ('operator', operator_inserts)):
+                for row in rows:
+                    if row[0] in self._tables[table] and not (table == 'drone' and
+                                                              row[0] in removed_drones):
+                        raise Exception('A %s with ID %s already exists' % (table, row[0]))
+            version = self._next_version()
+            for drone_id in removed_drones:
+                drones.pop(drone_id, None)
+                self._tables['removed_drone'][drone_id] = version
+            self._put('drone', drone_inserts, version)
+            self._put('operator', operator_inserts, version)
+            self._put('drone', drone_rows, version)
+            self._put('operator', operator_rows, version)
+            self._update('drone', DRONE_COLUMNS, drone_updates, version)
+            self._update('operator', OPERATOR_COLUMNS, operator_updates, version)
+
+    def write_maps(self, map_rows):
+        with self._lock:
+            self._put('map', map_rows, self._next_version())
+
+    def _next_version(self):
+        self._tables['version'] += 1
+        return self._tables['version']
+
+    def _put(self, table, rows, version):
+        versions = self._tables['versions'][table]
+        for row in rows:
+            self._tables[table][row[0]] = tuple(row)
+            versions[row[0]] = version
+
+    def _update(self, table, table_columns, updates, version):
+        rows = self._tables[table]
+        changed = []
+        for id, columns, values in updates:
+            # Like an SQL UPDATE, rows that no longer exist are left alone
+            if id in rows:
+                row = list(rows[id])
+                for column, value in zip(columns, values):
+                    row[table_columns.index(column)] = value
+                changed.append(row)
+        self._put(table, changed, version)
+
+    def _select(self, table, batch_size):
+        with self._lock:
+            rows = self._tables[table].values()
+        for start in xrange(0, len(rows), batch_size):
+            yield rows[start:start + batch_size]
+
+
+def local_path_from_config(path, section):
+    """ Returns the local file set with path in a section of a configuration file, relative to
+    the configuration file, or None if it is not set. """
+    config = SafeConfigParser()
+    config.read(path)
+    if not config.has_option(section, 'path') or not config.get(section, 'path'):
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(path)), config.get(section, 'path'))
+
+
+def backend_from_config(path):
+    """ Creates the storage backend selected in a configuration file.
+
+    The [storage] section chooses the backend with backend = mysql, sqlite or memory. MySQL
+    connection settings go in the [mysql] section, and the SQLite database file is set with
+    path in the [sqlite] section. """
+    config = SafeConfigParser()
+    if not config.read(path):
+        raise Exception('Configuration file %s could not be read' % path)
+
+    kind = config.get('storage', 'backend')
+    if kind == 'mysql':
+        return MySQLBackend(**dict(config.items('mysql')))
+    elif kind == 'sqlite':
+        return SQLiteBackend(config.get('sqlite', 'path'))
+    elif kind == 'memory':
+        return MemoryBackend()
+    else:
+        raise Exception('Unknown storage backend %s' % kind)
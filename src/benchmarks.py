@@ -0,0 +1,323 @@
+""" Benchmarks for DALSys, run against a synthetic fleet.
+
+    python benchmarks.py --drones 10000 --operators 100000 --output results.json
+    python benchmarks.py --compare results.json
+
+The Tk benchmarks are skipped when no display is available. """
+import argparse
+import cStringIO
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+import Tkinter as tk
+
+import numpy as np
+
+from backends import OPERATOR_COLUMNS, MemoryBackend, SQLiteBackend
+from bulk import export_rows, import_records, read_records, write_rows
+from drones import DroneStore
+from fleetgen import FleetSpec, fill_backend
+from maps import Map, MapStore
+from metrics import metrics
+from operators import OperatorStore
+from telemetry import (REPORT_DTYPE, TelemetryReceiver, coalesce, decode_datagrams,
+                       encode_reports)
+from trackingsystem import MAP_SIZE, TrackingSystem
+from unitofwork import UnitOfWork
+
+
+def measure(function, repeat=3):
+    """ Times a function, returning the best and median of several runs in seconds. """
+    times = []
+    for i in xrange(repeat):
+        start = default_timer()
+        function()
+        times.append(default_timer() - start)
+    times.sort()
+    return {'best': times[0], 'median': times[len(times) // 2], 'runs': repeat}
+
+
+def throughput(function, count, repeat=3):
+    """ Times a function that performs count operations and adds the operations per second. """
+    result = measure(function, repeat)
+    result['operations'] = count
+    result['per_second'] = count / result['best'] if result['best'] > 0 else None
+    return result
+
+
+class BenchmarkRun(object):
+    """ Runs the benchmarks against one backend filled with a synthetic fleet. """
+
+    def __init__(self, spec, backend_kind, repeat, operations):
+        self.spec = spec
+        self.backend_kind = backend_kind
+        self.repeat = repeat
+        self.operations = operations
+        self.results = {}
+        self._directory = tempfile.mkdtemp(prefix='dalsys-bench-')
+        self._root = None
+
+    def run(self):
+        try:
+            self._root = self._start_tk()
+            self._fill()
+            self.bench_loads()
+            self.bench_operator_lookup()
+            self.bench_save()
+            self.bench_allocate()
+            self.bench_ingest()
+            self.bench_bulk_import()
+            if self._root is None:
+                for name in ('startup', 'map_refresh'):
+                    self.results[name] = {'skipped': 'no display'}
+            else:
+                self.bench_startup()
+                self.bench_map_refresh()
+        finally:
+            if self._root is not None:
+                self._root.destroy()
+            shutil.rmtree(self._directory)
+        return self.results
+
+    def new_backend(self):
+        if self.backend_kind == 'sqlite':
+            return SQLiteBackend(os.path.join(self._directory, 'bench.sqlite'))
+        return self._memory.connect()
+
+    def _start_tk(self):
+        try:
+            root = tk.Tk()
+        except tk.TclError:
+            return None
+        root.withdraw()
+        return root
+
+    def _fill(self):
+        self._memory = MemoryBackend()
+        backend = self.new_backend()
+        self._drone_rows, self._operator_rows, map_rows = fill_backend(backend, self.spec,
+                                                                       self._directory)
+        if self._root is not None:
+            # Blank map images for the map viewer
+            for name, filepath in map_rows:
+                image = tk.PhotoImage(width=800, height=500)
+                image.put('#557755', to=(0, 0, 800, 500))
+                image.write(filepath, format='gif')
+
+    def bench_loads(self):
+        backend = self.new_backend()
+        self.results['load_drones'] = measure(lambda: DroneStore(backend), self.repeat)
+        self.results['load_operators'] = measure(lambda: OperatorStore(backend), self.repeat)
+        self.results['load_maps'] = measure(lambda: MapStore(backend), self.repeat)
+        # Loading is lazy, so also time creating every record
+        self.results['load_drones_all'] = measure(
+            lambda: list(DroneStore(backend).list_all()), self.repeat)
+        self.results['load_operators_all'] = measure(
+            lambda: list(OperatorStore(backend).list_all()), self.repeat)
+
+    def bench_operator_lookup(self):
+        operators = OperatorStore(self.new_backend())
+        rng = random.Random(self.spec.seed)
+        names = [rng.choice(operators.list_names()) for i in xrange(self.operations)]
+
+        def lookup():
+            for name in names:
+                operators.find_by_name(name)
+        self.results['operator_get_by_name'] = throughput(lookup, len(names), self.repeat)
+
+    def bench_save(self):
+        backend = self.new_backend()
+        unit_of_work = UnitOfWork(backend, max_pending=sys.maxint, max_delay=sys.maxint)
+        drones = DroneStore(backend, unit_of_work)
+        selected = [drones.get(row[0]) for row in self._drone_rows[:self.operations]]
+
+        def save():
+            for drone in selected:
+                drone.name = drone.name + '.'
+                drones.save(drone)
+            unit_of_work.flush()
+        self.results['drone_save'] = throughput(save, len(selected), self.repeat)
+
+    def bench_allocate(self):
+        # Pair free drones with free operators that pass the allocation rules
+        free_operators = {}
+        for row in self._operator_rows:
+            if row[7] is None:
+                free_operators.setdefault((row[4], bool(row[5])), []).append(row[0])
+        pairs = []
+        for row in self._drone_rows:
+            if row[4] is None and len(pairs) < self.operations:
+                candidates = free_operators.get((row[2], True), [])
+                if not row[3]:
+                    candidates = free_operators.get((row[2], False), []) or candidates
+                if candidates:
+                    pairs.append((row[0], candidates.pop()))
+
+        def allocate():
+            # Each run starts from a fresh store, as allocations cannot be repeated
+            backend = self.new_backend()
+            unit_of_work = UnitOfWork(backend)
+            drones = DroneStore(backend, unit_of_work)
+            operators = OperatorStore(backend, unit_of_work)
+            for drone_id, operator_id in pairs:
+                action = drones.allocate(drones.get(drone_id), operators.get(operator_id))
+                operators.commit_allocation(action)
+        # Metrics are on to count what each allocation costs the database - the allocations
+        # are written to the shared backend, so they can only be run once
+        metrics.reset()
+        metrics.enabled = True
+        try:
+            self.results['allocate_commit'] = throughput(allocate, len(pairs), 1)
+        finally:
+            metrics.enabled = False
+        stats = metrics.snapshot()
+        statements = sum(stat['count'] for name, stat in stats.iteritems()
+                         if name.startswith('sql.') and not name in ('sql.fetch', 'sql.commit',
+                                                                      'sql.rollback'))
+        for name, count in (('sql_statements', statements),
+                            ('sql_commits', stats.get('sql.commit', {}).get('count', 0)),
+                            ('db_writes', stats.get('db.write', {}).get('count', 0))):
+            self.results['allocate_commit'][name + '_per_allocation'] = \
+                float(count) / max(len(pairs), 1)
+        metrics.reset()
+
+    def bench_ingest(self):
+        # Ten reports for each drone, taking the drones in turn as a busy fleet would
+        drone_ids = np.array([row[0] for row in self._drone_rows], dtype=np.int32)
+        count = 10 * len(drone_ids)
+        rng = np.random.RandomState(self.spec.seed)
+        reports = np.empty(count, dtype=REPORT_DTYPE)
+        reports['drone_id'] = np.tile(drone_ids, 10)
+        reports['time'] = time.time() + np.arange(count) * 1e-4
+        reports['x'] = rng.uniform(0, MAP_SIZE, count)
+        reports['y'] = rng.uniform(0, MAP_SIZE, count)
+        datagrams = encode_reports(reports)
+        tracker = TrackingSystem()
+        tracker.track_many(Map('Telemetry', None), drone_ids.tolist())
+
+        def ingest():
+            latest = coalesce(decode_datagrams(datagrams)[0])
+            tracker.apply_reports(latest['drone_id'], latest['x'], latest['y'])
+        self.results['ingest_apply'] = throughput(ingest, count, self.repeat)
+
+        # The same reports through a socket - datagrams the receiver could not keep up with
+        # are lost, so the share received is recorded too
+        received = []
+
+        def ingest_udp():
+            receiver = TelemetryReceiver(0)
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                for datagram in datagrams:
+                    sender.sendto(datagram, ('127.0.0.1', receiver.port))
+                # Wait for the receiver to go quiet
+                last = -1
+                while receiver.received != last:
+                    last = receiver.received
+                    time.sleep(0.05)
+                latest = receiver.take()
+                tracker.apply_reports(latest['drone_id'], latest['x'], latest['y'])
+                received.append(receiver.received)
+            finally:
+                sender.close()
+                receiver.stop()
+        self.results['ingest_udp'] = throughput(ingest_udp, count, self.repeat)
+        self.results['ingest_udp']['received'] = float(min(received)) / count
+
+    def bench_bulk_import(self):
+        exported = cStringIO.StringIO()
+        write_rows(exported, 'csv', OPERATOR_COLUMNS, export_rows('operators', self.new_backend()))
+
+        def bulk_import():
+            # Each run imports into an empty backend
+            records = read_records(cStringIO.StringIO(exported.getvalue()), 'csv')
+            import_records('operators', records, MemoryBackend())
+        self.results['bulk_import_operators'] = throughput(bulk_import, len(self._operator_rows),
+                                                           self.repeat)
+
+    def bench_startup(self):
+        # Imported here as the application needs a display
+        from app import Application
+
+        timers = []
+
+        def startup():
+            app = Application(self.new_backend(), background_writes=False)
+            app.root.update()
+            app.finish_loading()
+            app.root.destroy()
+            timers.append(app.startup_timer)
+        self.results['startup'] = measure(startup, self.repeat)
+        self.results['startup']['phases'] = dict(timers[-1].phases())
+
+    def bench_map_refresh(self):
+        from app import Application, MapWindow
+        app = Application(self.new_backend(), background_writes=False)
+        try:
+            app.root.withdraw()
+            app.finish_loading()
+            window = MapWindow(app)
+            app.root.update()
+
+            def refresh():
+                window.refresh_drones()
+                app.root.update_idletasks()
+            self.results['map_refresh'] = measure(refresh, max(self.repeat, 10))
+        except tk.TclError as error:
+            self.results['map_refresh'] = {'skipped': str(error)}
+        finally:
+            app.root.destroy()
+
+
+def compare(previous, current):
+    """ Prints how each benchmark's best time has changed since a previous run. """
+    for name in sorted(current['results']):
+        new = current['results'][name]
+        old = previous['results'].get(name, {})
+        if 'best' in new and 'best' in old and old['best'] > 0:
+            print('%-22s %10.4fs -> %10.4fs  (%.2fx)' % (name, old['best'], new['best'],
+                                                        new['best'] / old['best']))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Run the DALSys benchmarks.')
+    parser.add_argument('--drones', type=int, default=1000)
+    parser.add_argument('--operators', type=int, default=10000)
+    parser.add_argument('--maps', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=280)
+    parser.add_argument('--backend', choices=('memory', 'sqlite'), default='memory')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--operations', type=int, default=1000,
+                        help='number of saves, lookups and allocations to time')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    spec = FleetSpec(drones=args.drones, operators=args.operators, maps=args.maps, seed=args.seed)
+    run = BenchmarkRun(spec, args.backend, args.repeat, args.operations)
+    report = {'spec': spec.as_dict(),
+              'backend': args.backend,
+              'python': sys.version,
+              'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'results': run.run()}
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            results_file.write(output)
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(json.load(previous_file), report)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,278 @@
+""" Imports and exports drones and operators from the command line, without the GUI.
+
+    python bulk.py import operators new_operators.csv
+    python bulk.py import drones drones.jsonl --chunk-size 500
+    python bulk.py export operators operators.csv
+
+CSV files start with a header row naming the columns and JSON lines files have one object per
+line, using the column names of the database tables. The format is taken from the file
+extension unless --format is given, and - reads from or writes to the console. Imported records
+are given new IDs, so their ID and allocation columns are ignored. """
+import argparse
+import csv
+import json
+import os
+import sys
+from datetime import datetime
+
+from backends import DRONE_COLUMNS, OPERATOR_COLUMNS, backend_from_config
+from drones import Drone, DroneStore
+from maps import MapStore
+from operators import Operator, OperatorStore
+from unitofwork import UnitOfWork
+
+# Number of records validated and written together in one transaction
+IMPORT_CHUNK_SIZE = 1000
+
+# Number of rows fetched from the database at a time when exporting
+EXPORT_BATCH_SIZE = 1000
+
+COLUMNS = {'drones': DRONE_COLUMNS, 'operators': OPERATOR_COLUMNS}
+
+
+def read_records(stream, format):
+    """ Reads (line number, record) pairs from a CSV or JSON lines file, where each record is a
+    dictionary keyed by column name. Lines that cannot be read give a record of None, which
+    the parsers reject. """
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            # Columns missing from a short row are None, and are treated as blank
+            yield reader.line_num, dict((key, value.decode('utf-8') if value is not None else None)
+                                        for key, value in record.iteritems() if key is not None)
+    else:
+        for number, line in enumerate(stream, 1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, None
+
+
+def write_rows(stream, format, columns, rows):
+    """ Writes database rows to a CSV or JSON lines file. """
+    if format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([_text(value).encode('utf-8') for value in row])
+    else:
+        for row in rows:
+            stream.write(json.dumps(dict(zip(columns, [_json_value(value) for value in row]))))
+            stream.write('\n')
+
+
+def parse_drone(record):
+    """ Creates a Drone from an imported record. """
+    _check_record(record)
+    drone = Drone(_string(record, 'name'), _int(record, 'class_type', 1),
+                  _int(record, 'rescue', 0))
+    drone.map = _string(record, 'map_id')
+    return drone
+
+
+def parse_operator(record):
+    """ Creates an Operator from an imported record. """
+    _check_record(record)
+    operator = Operator()
+    operator.first_name = _string(record, 'first_name')
+    operator.family_name = _string(record, 'family_name')
+    date_of_birth = _string(record, 'date_of_birth')
+    if date_of_birth is not None:
+        try:
+            operator.date_of_birth = datetime.strptime(date_of_birth, '%Y-%m-%d').date()
+        except ValueError:
+            raise ValueError('date_of_birth must be written as YYYY-MM-DD')
+    operator.drone_license = _int(record, 'drone_license')
+    operator.rescue_endorsement = _int(record, 'rescue_endorsement', 0)
+    operator.operations = _int(record, 'operations', 0)
+    return operator
+
+
+def import_records(kind, records, backend, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """ Adds (line number, record) pairs to the drones or operators in chunks. Each chunk is
+    validated, then written in a single transaction. Returns the number of records imported
+    and a list of (line number, messages) for those rejected.
+
+    progress, if given, is called with the number imported so far after each chunk. """
+    # Nothing is written until the end of each chunk
+    unit_of_work = UnitOfWork(backend, max_pending=sys.maxint, max_delay=sys.maxint)
+    # The stores are not loaded, as the new records take IDs reserved from the database
+    if kind == 'drones':
+        store = DroneStore(backend, unit_of_work, load=False)
+        map_names = set(map_.name for map_ in MapStore(backend).list_all())
+        add = lambda record: _add_drone(store, map_names, record)
+    elif kind == 'operators':
+        store = OperatorStore(backend, unit_of_work, load=False)
+        add = lambda record: _add_operator(store, record)
+    else:
+        raise Exception('Unknown record kind %s' % kind)
+
+    imported = 0
+    rejected = []
+    chunk = []
+    for pair in records:
+        chunk.append(pair)
+        if len(chunk) == chunk_size:
+            imported += _import_chunk(unit_of_work, add, chunk, rejected)
+            chunk = []
+            if progress is not None:
+                progress(imported)
+    if chunk:
+        imported += _import_chunk(unit_of_work, add, chunk, rejected)
+        if progress is not None:
+            progress(imported)
+    return imported, rejected
+
+
+def export_rows(kind, backend, batch_size=EXPORT_BATCH_SIZE):
+    """ Lists the database rows of the drones or operators, fetching them a batch at a time. """
+    if kind == 'drones':
+        batches = backend.load_drones(batch_size)
+    elif kind == 'operators':
+        batches = backend.load_operators(batch_size)
+    else:
+        raise Exception('Unknown record kind %s' % kind)
+    for rows in batches:
+        for row in rows:
+            yield row
+
+
+def _import_chunk(unit_of_work, add, chunk, rejected):
+    imported = 0
+    with unit_of_work.transaction():
+        for number, record in chunk:
+            try:
+                messages = add(record)
+            except ValueError as error:
+                messages = [str(error)]
+            if messages:
+                rejected.append((number, messages))
+            else:
+                imported += 1
+    return imported
+
+
+def _add_drone(store, map_names, record):
+    """ Adds a drone if it passes the same checks as the drone editor, returning the reasons
+    it was rejected. """
+    drone = parse_drone(record)
+    messages = []
+    if not drone.name:
+        messages.append("Name is required")
+    if not drone.class_type in (1, 2):
+        messages.append("Class must be 1 or 2")
+    if drone.map is not None and not drone.map in map_names:
+        messages.append("Map %s does not exist" % drone.map)
+    if not messages:
+        store.add(drone)
+    return messages
+
+
+def _add_operator(store, record):
+    """ Adds an operator if it passes the OperatorStore.add rules, returning the reasons it was
+    rejected. """
+    action = store.add(parse_operator(record))
+    if action.is_valid():
+        action.commit()
+    return action.messages
+
+
+def _check_record(record):
+    if not isinstance(record, dict):
+        raise ValueError('Line is not a valid record')
+
+
+def _value(record, column):
+    """ Returns a column of a record, with blank values as None. """
+    value = record.get(column)
+    if value == '':
+        return None
+    return value
+
+
+def _string(record, column):
+    """ Returns a text column of a record, with blank values as None. """
+    value = _value(record, column)
+    if value is not None and not isinstance(value, basestring):
+        raise ValueError('%s must be text' % column)
+    return value
+
+
+def _int(record, column, default=None):
+    value = _value(record, column)
+    if value is None:
+        return default
+    if value in ('true', 'True', True):
+        return 1
+    if value in ('false', 'False', False):
+        return 0
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('%s must be a whole number' % column)
+
+
+def _text(value):
+    if value is None:
+        return u''
+    if hasattr(value, 'isoformat'):
+        return unicode(value.isoformat())
+    return unicode(value)
+
+
+def _json_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def _format(path, format):
+    if format is not None:
+        return format
+    if os.path.splitext(path)[1].lower() == '.csv':
+        return 'csv'
+    return 'jsonl'
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Import or export drones and operators.')
+    parser.add_argument('action', choices=('import', 'export'))
+    parser.add_argument('kind', choices=('drones', 'operators'))
+    parser.add_argument('path', help='file to read or write, or - for the console')
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help='file format (default: from the file extension)')
+    parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE,
+                        help='records written in each transaction')
+    parser.add_argument('--config', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'dalsys.ini'))
+    args = parser.parse_args(argv)
+
+    format = _format(args.path, args.format)
+    backend = backend_from_config(args.config)
+    try:
+        if args.action == 'import':
+            stream = sys.stdin if args.path == '-' else open(args.path, 'rb')
+            try:
+                progress = lambda count: sys.stderr.write('Imported %d %s\n' % (count, args.kind))
+                imported, rejected = import_records(args.kind, read_records(stream, format),
+                                                    backend, args.chunk_size, progress)
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+            for number, messages in rejected:
+                sys.stderr.write('Line %d: %s\n' % (number, '; '.join(messages)))
+            print('Imported %d %s, rejected %d' % (imported, args.kind, len(rejected)))
+        else:
+            stream = sys.stdout if args.path == '-' else open(args.path, 'wb')
+            try:
+                write_rows(stream, format, COLUMNS[args.kind], export_rows(args.kind, backend))
+            finally:
+                if stream is not sys.stdout:
+                    stream.close()
+    finally:
+        backend.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
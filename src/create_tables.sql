@@ -2,7 +2,9 @@ CREATE TABLE map (
   map_id INT, 
   name VARCHAR(50), 
   filepath VARCHAR(100), 
-  PRIMARY KEY(name)
+  row_version BIGINT DEFAULT 0, 
+  PRIMARY KEY(name),
+  INDEX(row_version)
 );
 
 CREATE TABLE drone (
@@ -12,7 +14,9 @@ CREATE TABLE drone (
   rescue BOOLEAN, 
   operator_id INT, 
   map_id VARCHAR(50), 
+  row_version BIGINT DEFAULT 0, 
   PRIMARY KEY(drone_id),
+  INDEX(row_version),
   FOREIGN KEY(map_id) REFERENCES map(name),
   FOREIGN KEY(operator_id) REFERENCES operator(operator_id)
 );
@@ -27,6 +31,31 @@ CREATE TABLE operator (
   rescue_endorsement BOOLEAN, 
   operations INT, 
   drone_id INT, 
+  row_version BIGINT DEFAULT 0, 
   PRIMARY KEY(operator_id),
+  INDEX(row_version),
   FOREIGN KEY(drone_id) REFERENCES drone(drone_id)
-);
\ No newline at end of file
+);
+
+CREATE TABLE removed_drone (
+  drone_id INT, 
+  row_version BIGINT, 
+  PRIMARY KEY(drone_id),
+  INDEX(row_version)
+);
+
+CREATE TABLE sync_version (
+  id INT, 
+  version BIGINT, 
+  PRIMARY KEY(id)
+);
+
+INSERT INTO sync_version VALUES (1, 0);
+
+CREATE TABLE id_block (
+  table_name VARCHAR(50), 
+  next_id BIGINT, 
+  PRIMARY KEY(table_name)
+);
+
+INSERT INTO id_block VALUES ('drone', 1), ('operator', 1);
\ No newline at end of file
@@ -0,0 +1,65 @@
+import Queue
+import threading
+
+# How often (in milliseconds) the Tk thread collects the results of finished work
+POLL_INTERVAL = 50
+
+
+class DatabaseWorker(object):
+    """ Runs storage work on a dedicated thread with its own backend connection, so the Tk main
+    loop never waits on the database. Completion callbacks are run back on the Tk thread. """
+
+    def __init__(self, connect, root=None):
+        self._connect = connect
+        self._root = root
+        self._requests = Queue.Queue()
+        self._results = Queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='DatabaseWorker')
+        self._thread.daemon = True
+        self._thread.start()
+        if root is not None:
+            root.after(POLL_INTERVAL, self._poll)
+
+    def submit(self, work, on_done=None, on_error=None):
+        """ Queues work(backend) to run on the worker thread. on_done is called with its result,
+        or on_error with the exception it raised, on the Tk thread. """
+        self._requests.put((work, on_done, on_error))
+
+    def stop(self):
+        """ Finishes the queued work, closes the backend and runs the remaining callbacks. """
+        self._requests.put(None)
+        self._thread.join()
+        self.process_results()
+
+    def process_results(self):
+        """ Runs the callbacks for the work that has finished. """
+        while True:
+            try:
+                callback, value = self._results.get_nowait()
+            except Queue.Empty:
+                return
+            if callback is not None:
+                callback(value)
+
+    def _poll(self):
+        self.process_results()
+        self._root.after(POLL_INTERVAL, self._poll)
+
+    def _run(self):
+        backend = None
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            work, on_done, on_error = request
+            try:
+                # Connect on first use, and again after a failed connection attempt
+                if backend is None:
+                    backend = self._connect()
+                result = work(backend)
+            except Exception as error:
+                self._results.put((on_error, error))
+            else:
+                self._results.put((on_done, result))
+        if backend is not None:
+            backend.close()
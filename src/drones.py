@@ -1,6 +1,13 @@
+from backends import LOAD_BATCH_SIZE, IdAllocator
+from metrics import timed
+from sharedvalues import SharedValues
+from unitofwork import UnitOfWork, drone_row
+
 class Drone(object):
     """ Stores details on a drone. """
 
+    __slots__ = ('id', 'name', 'class_type', 'rescue', 'operator', 'map', 'location', '_saved')
+
     def __init__(self, name, class_type=1, rescue=False):
         self.id = 0
         self.name = name
@@ -9,11 +16,15 @@ class Drone(object):
         self.operator = None
         self.map = None
         self.location = None
+        # The database row as last loaded or written, or None if the drone has not been saved
+        self._saved = None
 
 
 class DroneAction(object):
     """ A pending action on the DroneStore. """
 
+    __slots__ = ('drone', 'operator', 'messages', '_commit_action', '_committed')
+
     def __init__(self, drone, operator, commit_action):
         self.drone = drone
         self.operator = operator
@@ -39,61 +50,245 @@ class DroneAction(object):
         return self.operator
 
 
+class AllocationPlan(object):
+    """ A pending allocation of many drones to many operators. """
+
+    __slots__ = ('drones', 'released', 'pairs', 'messages', '_commit_action', '_committed')
+
+    def __init__(self, drones, released, pairs, commit_action):
+        # The drones being re-allocated, and the operators giving up one of those drones
+        self.drones = drones
+        self.released = released
+        # The (drone, operator) pairs that will be allocated
+        self.pairs = pairs
+        self.messages = []
+        self._commit_action = commit_action
+        self._committed = False
+
+    def add_message(self, message):
+        """ Adds a message to the plan. """
+        self.messages.append(message)
+
+    def unallocated(self):
+        """ Lists the drones that will be left without an operator. """
+        allocated = set(drone.id for drone, operator in self.pairs)
+        return [drone for drone in self.drones if not drone.id in allocated]
+
+    def commit(self):
+        """ Commits (performs) this plan, returning the operators that have changed. """
+        if self._committed:
+            raise Exception("Plan has already been committed")
+
+        operators = self._commit_action(self)
+        self._committed = True
+        return operators
+
+
 class DroneStore(object):
     """ DroneStore stores all the drones for DALSys. """
 
-    def __init__(self, conn=None):
+    def __init__(self, backend=None, unit_of_work=None, on_load=None, load=True):
         self._drones = {}
+        # Rows loaded from the database that have not been turned into Drones yet
+        self._rows = {}
         self._last_id = 0
-        self._conn = conn
-        if conn != None:
+        self._backend = backend
+        # New drones take IDs reserved from the database, so other instances cannot reuse them
+        self._ids = IdAllocator(backend, 'drone') if backend is not None else None
+        # Called with each drone loaded from the database when it is first used
+        self._on_load = on_load
+        # Secondary indexes: name -> drone IDs and operator ID -> drone ID, plus the keys each
+        # drone is currently indexed under so they can be moved when the drone changes
+        self._name_index = {}
+        self._operator_index = {}
+        self._indexed_names = {}
+        self._indexed_operators = {}
+        # One shared copy of each map name held by the loaded rows
+        self._values = SharedValues((5,))
+        if unit_of_work is None and backend != None:
+            unit_of_work = UnitOfWork(backend)
+        self._unit_of_work = unit_of_work
+        # Without load, the store only holds the drones added to it
+        if backend != None and load:
             self.fill_from_db()
             
-    def fill_from_db(self):
-        cursor = self._conn.cursor()
-        cursor.execute("SELECT * FROM drone")
-        result = cursor.fetchall()
-        for line in result:
-            new_drone = Drone(line[1], int(line[2]), int(line[3]))
-            if line[4] != None:
-                new_drone.operator = line[4]
-            if line[5] != None:
-                new_drone.map = line[5]
-            self.add(new_drone)
+    @timed('drones.fill_from_db')
+    def fill_from_db(self, batch_size=LOAD_BATCH_SIZE):
+        """ Loads the drones from the database in batches - each Drone is only created when it
+        is first used. """
+        for rows in self._backend.load_drones(batch_size):
+            self.load_rows(rows)
+
+    @timed('drones.load_rows', rows=lambda self, rows: len(rows))
+    def load_rows(self, rows):
+        """ Adds a batch of rows loaded from the database, returning the IDs of their drones. """
+        ids = []
+        for row in rows:
+            id = int(row[0])
+            row = self._values.share(row)
+            if id in self._rows:
+                self._values.release(self._rows[id])
+            self._rows[id] = row
+            self._index_record(id, row[1], row[4])
+            self._last_id = max(self._last_id, id)
+            ids.append(id)
+        return ids
+
+    @timed('drones.hydrate')
+    def _hydrate(self, id):
+        """ Creates the Drone for a row loaded from the database. """
+        line = self._rows.pop(id)
+        self._values.release(line)
+        # Loaded drones keep their database IDs and are not marked as changed
+        new_drone = Drone(line[1], int(line[2]), int(line[3]))
+        new_drone.id = id
+        if line[4] != None:
+            new_drone.operator = line[4]
+        if line[5] != None:
+            new_drone.map = line[5]
+        new_drone._saved = drone_row(new_drone)
+        self._drones[id] = new_drone
+        if self._on_load is not None:
+            self._on_load(new_drone)
+        return new_drone
 
+    @timed('drones.apply_changes', rows=lambda self, rows, removed=(): len(rows) + len(removed))
+    def apply_changes(self, rows, removed=()):
+        """ Applies drones changed and removed in the database since they were loaded. Drones
+        with changes of their own still to be saved are left as they are. Returns the IDs of
+        the drones changed and of those removed. """
+        changed = []
+        for row in rows:
+            id = int(row[0])
+            if self._has_own_changes(id):
+                continue
+            if id in self._drones:
+                drone = self._drones[id]
+                if drone_row(drone) == tuple(row):
+                    continue
+                # Update the drone in place, so anything holding it sees the change
+                drone.name = row[1]
+                drone.class_type = int(row[2])
+                drone.rescue = int(row[3])
+                drone.operator = row[4]
+                drone.map = row[5]
+                drone._saved = drone_row(drone)
+                self._index_record(id, drone.name, drone.operator)
+                if self._on_load is not None:
+                    self._on_load(drone)
+            elif self._rows.get(id) == tuple(row):
+                continue
+            else:
+                self.load_rows([row])
+            changed.append(id)
+
+        removed_ids = []
+        for id in removed:
+            if self._has_own_changes(id):
+                continue
+            if id in self._drones:
+                del self._drones[id]
+            elif id in self._rows:
+                self._values.release(self._rows.pop(id))
+            else:
+                continue
+            self._unindex(id)
+            removed_ids.append(id)
+        return changed, removed_ids
+
+    def _has_own_changes(self, id):
+        return self._unit_of_work is not None and self._unit_of_work.state('drone', id) is not None
+
+    @timed('drones.add')
     def add(self, drone):
         """ Adds a new drone to the store. """
-        if drone.id in self._drones:
+        if drone.id in self._drones or drone.id in self._rows:
             raise Exception('Drone already exists in store')
         else:
-            self._last_id += 1
-            drone.id = self._last_id
+            drone.id = self._ids.next_id() if self._ids is not None else self._last_id + 1
+            self._last_id = max(self._last_id, drone.id)
             self._drones[drone.id] = drone
             self.save(drone)
 
+    @timed('drones.remove')
     def remove(self, drone):
         """ Removes a drone from the store. """
+        if drone.id in self._rows:
+            self._hydrate(drone.id)
         if not drone.id in self._drones:
             raise Exception('Drone does not exist in store')
         else:
             del self._drones[drone.id]
-            cursor = self._conn.cursor()
-            sql_str = "DELETE FROM drone WHERE drone_id = %d;" % drone.id
-            cursor.execute(sql_str)
-            self._conn.commit()
+            self._unindex(drone.id)
+            # Saving the drone again writes the whole row, replacing it if the delete has not
+            # been written yet
+            drone._saved = ()
+            if self._unit_of_work is not None:
+                self._unit_of_work.register_removed_drone(drone)
 
     def get(self, id):
         """ Retrieves a drone from the store by its ID. """
+        if id in self._rows:
+            self._hydrate(id)
         if not id in self._drones:
             return None
         else:
             return self._drones[id]
 
+    def get_by_name(self, name):
+        """ Retrieves a drone from the store by its name. """
+        drones = self.find_by_name(name)
+        if len(drones) > 1:
+            raise Exception('More than one drone is named %s' % name)
+        elif len(drones) == 0:
+            return None
+        else:
+            return drones[0]
+
+    def find_by_name(self, name):
+        """ Retrieves all the drones with the given name. """
+        return [self.get(id) for id in self._name_index.get(name, ())]
+
+    def get_by_operator(self, operator_id):
+        """ Retrieves the drone allocated to an operator. """
+        if not operator_id in self._operator_index:
+            return None
+        else:
+            return self.get(self._operator_index[operator_id])
+
+    def list_ids(self):
+        """ Lists the IDs of all the drones in the system, in ID order. """
+        return sorted(self._drones.keys() + self._rows.keys())
+
+    def list_names(self):
+        """ Lists the distinct names of the drones in the system. """
+        return self._name_index.keys()
+
+    def list_maps(self, ids=None):
+        """ Lists the (drone ID, map name) pair of every drone, or of the drones with the given
+        IDs, without loading the drones. """
+        if ids is None:
+            ids = self.list_ids()
+        for id in ids:
+            if id in self._rows:
+                yield id, self._rows[id][5]
+            elif id in self._drones:
+                drone = self._drones[id]
+                yield id, getattr(drone.map, 'name', drone.map)
+
+    def list_rows(self):
+        """ Lists the database row of every drone, without loading the drones. """
+        for row in self._rows.itervalues():
+            yield row
+        for drone in self._drones.itervalues():
+            yield drone_row(drone)
+
     def list_all(self):
         """ Lists all the drones in the system. """
-        for key, value in self._drones.iteritems():
-            yield value
+        for id in self.list_ids():
+            yield self.get(id)
 
+    @timed('drones.allocate')
     def allocate(self, drone, operator):
         """ Starts the allocation of a drone to an operator. """
         action = DroneAction(drone, operator, self._allocate)
@@ -111,32 +306,125 @@ class DroneStore(object):
 
         return action
 
+    @timed('drones.allocate_many', rows=lambda self, drones, *args, **kwargs: len(drones))
+    def allocate_many(self, drones, operators, weighted=False):
+        """ Plans the allocation of a set of drones to a set of operators, allocating as many
+        drones as the allocation rules allow.
+
+        Operators already flying one of the drones are released from it, and operators flying
+        any other drone are left out. Drones flown by an operator outside the set are left as
+        they are. If weighted is True, the operators with the most operations are preferred. """
+        drones = list(drones)
+        drone_ids = set(drone.id for drone in drones)
+        operator_ids = set(operator.id for operator in operators)
+        released = [op for op in operators if op.drone is not None and op.drone in drone_ids]
+        available = [op for op in operators if op.drone is None or op.drone in drone_ids]
+        if weighted:
+            available.sort(key=lambda operator: operator.operations, reverse=True)
+
+        planned = []
+        skipped = []
+        for drone in drones:
+            if drone.operator is None or drone.operator in operator_ids:
+                planned.append(drone)
+            else:
+                skipped.append(drone)
+
+        plan = AllocationPlan(planned, released, self._match(planned, available),
+                              self._allocate_many)
+        for drone in skipped:
+            plan.add_message("Drone %s is flown by an operator outside the set" % drone.name)
+        for drone in plan.unallocated():
+            plan.add_message("No operator can be allocated to drone %s" % drone.name)
+        return plan
+
+    def _match(self, drones, operators):
+        """ Finds a maximum matching of drones to operators under the allocation rules.
+
+        The rules only depend on the class and rescue flag of a drone and the license and
+        endorsement of an operator, so for each class an endorsed operator can fly any of its
+        drones and an unendorsed operator only the non-rescue ones. A set of operators can be
+        matched while no more unendorsed operators are taken than there are non-rescue drones
+        and no more operators in total than drones. Taking each operator in turn while that
+        holds gives a maximum matching, and one with the most operations when the operators
+        are taken in order of operations. """
+        groups = {}
+        for drone in drones:
+            group = groups.setdefault(drone.class_type, ([], [], [], []))
+            group[0 if drone.rescue else 1].append(drone)
+        for operator in operators:
+            if operator.drone_license in groups:
+                group = groups[operator.drone_license]
+                rescue, other, endorsed, unendorsed = group
+                if operator.rescue_endorsement:
+                    if len(endorsed) + len(unendorsed) < len(rescue) + len(other):
+                        endorsed.append(operator)
+                elif len(unendorsed) < len(other) and \
+                        len(endorsed) + len(unendorsed) < len(rescue) + len(other):
+                    unendorsed.append(operator)
+
+        pairs = []
+        for rescue, other, endorsed, unendorsed in groups.values():
+            # Endorsed operators go to the rescue drones first, the rest share the other drones
+            pairs.extend(zip(rescue, endorsed))
+            pairs.extend(zip(other, unendorsed + endorsed[len(rescue):]))
+        return pairs
+
+    def _allocate_many(self, plan):
+        """ Performs the allocations in a plan. """
+        changed = dict((operator.id, operator) for operator in plan.released)
+        for operator in plan.released:
+            operator.drone = None
+        for drone in plan.drones:
+            drone.operator = None
+        for drone, operator in plan.pairs:
+            drone.operator = operator.id
+            operator.drone = drone.id
+            changed[operator.id] = operator
+        for drone in plan.drones:
+            self.save(drone)
+        return changed.values()
+
     def _allocate(self, drone, operator):
         """ Performs the actual allocation of the operator to the drone. """
-        if operator.drone is not None:
+        previous = self.get_by_operator(operator.id)
+        if previous is not None and previous is not drone:
             # If the operator had a drone previously, we need to clean it so it does not
             # hold an incorrect reference
-            operator.drone.operator = None
+            previous.operator = None
+            self.save(previous)
         operator.drone = drone.id
         drone.operator = operator.id
         self.save(drone)
 
+    @timed('drones.save')
     def save(self, drone):
-        """ Saves the drone to the database. """
-        cursor = self._conn.cursor()
-        sql_str = "SELECT * FROM drone WHERE drone_id = {};".format(drone.id)
-        cursor.execute(sql_str)
-        if cursor.fetchone() == None:
-            # This will run if the drone is not already in the database (adding a new drone)
-            sql_str = "INSERT INTO drone () VALUES(%d, \"%s\", %d, %d, NULL, NULL);"% (drone.id, drone.name, drone.class_type, drone.rescue)
-            cursor.execute(sql_str)
-            self._conn.commit()
-        else:
-            # This will run if the drone already exists (update drone)
-            if drone.operator == None:
-                sql_str = "UPDATE drone SET name = \"%s\", class_type = %d, rescue = %d WHERE drone_id = %d;" % (drone.name, drone.class_type, drone.rescue, drone.id)
-            else:
-                sql_str = "UPDATE drone SET name = \"%s\", class_type = %d, rescue = %d, operator_id = %d WHERE drone_id = %d;" % (drone.name, drone.class_type, drone.rescue, drone.operator, drone.id)
-            cursor.execute(sql_str)
-            self._conn.commit()
+        """ Records the drone as changed - it is written when the unit of work is flushed.
+        Drones that match their database row, or the row still being written, are skipped. """
+        if drone.id in self._drones:
+            self._index_record(drone.id, drone.name, drone.operator)
+        if self._unit_of_work is not None and self._unit_of_work.needs_write(
+                'drone', drone, drone_row(drone)):
+            self._unit_of_work.register_drone(drone)
+
+    def _index_record(self, id, name, operator_id):
+        """ Updates the secondary indexes for a drone. """
+        self._unindex(id)
+        self._name_index.setdefault(name, set()).add(id)
+        self._indexed_names[id] = name
+        if operator_id is not None:
+            self._operator_index[operator_id] = id
+            self._indexed_operators[id] = operator_id
 
+    def _unindex(self, id):
+        """ Removes a drone from the secondary indexes. """
+        if id in self._indexed_names:
+            name = self._indexed_names.pop(id)
+            ids = self._name_index[name]
+            ids.discard(id)
+            if not ids:
+                del self._name_index[name]
+        if id in self._indexed_operators:
+            operator_id = self._indexed_operators.pop(id)
+            if self._operator_index.get(operator_id) == id:
+                del self._operator_index[operator_id]
@@ -0,0 +1,97 @@
+import os
+import random
+from datetime import date, timedelta
+
+FIRST_NAMES = ('Alex', 'Bobby', 'Charlie', 'David', 'Emma', 'Frankie', 'Grace', 'Hemi', 'Isla',
+               'Jordan', 'Kiri', 'Liam', 'Mere', 'Noah', 'Olivia', 'Pita', 'Quinn', 'Ruby',
+               'Sam', 'Tama')
+FAMILY_NAMES = ('Anderson', 'Brown', 'Chen', 'Davies', 'Edwards', 'Fletcher', 'Green', 'Harris',
+                'Ito', 'Jones', 'King', 'Lee', 'Martin', 'Ngata', 'O\'Brien', 'Patel', 'Rangi',
+                'Smith', 'Taylor', 'Wilson')
+
+
+class FleetSpec(object):
+    """ Describes the size and mix of a synthetic fleet. """
+
+    def __init__(self, drones=1000, operators=10000, maps=5, class_two=0.3, rescue=0.2,
+                 endorsed=0.3, allocated=0.5, seed=280):
+        self.drones = drones
+        self.operators = operators
+        self.maps = maps
+        # Fractions of drones that are class two and rescue drones
+        self.class_two = class_two
+        self.rescue = rescue
+        # Fraction of qualifying operators (five or more operations) with a rescue endorsement
+        self.endorsed = endorsed
+        # Fraction of drones allocated to an eligible operator
+        self.allocated = allocated
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+def generate_fleet(spec):
+    """ Generates (drone rows, operator rows, map rows) for a fleet, in the column order used by
+    the storage backends. The same spec always generates the same fleet. """
+    rng = random.Random(spec.seed)
+    today = date.today()
+
+    map_rows = [('Map %d' % (i + 1), 'map%d.gif' % (i + 1)) for i in xrange(spec.maps)]
+
+    operators = []
+    for index in xrange(spec.operators):
+        id = index + 1
+        license = 2 if rng.random() < spec.class_two else 1
+        # Class two holders must be at least twenty
+        min_age = 20 if license == 2 else 16
+        date_of_birth = today - timedelta(days=rng.randint(min_age * 366, 65 * 365))
+        operations = rng.randint(0, 50)
+        rescue = int(operations >= 5 and rng.random() < spec.endorsed)
+        if index < len(FIRST_NAMES) * len(FAMILY_NAMES):
+            # Keep the names unique while there are combinations left
+            first_name = FIRST_NAMES[index % len(FIRST_NAMES)]
+            family_name = FAMILY_NAMES[index // len(FIRST_NAMES)]
+        else:
+            first_name = rng.choice(FIRST_NAMES)
+            family_name = '%s-%d' % (rng.choice(FAMILY_NAMES), id)
+        operators.append([id, first_name, family_name, date_of_birth, license, rescue,
+                          operations, None])
+
+    # Group the operators by what they can fly, so allocations follow the allocation rules
+    free = {}
+    for operator in operators:
+        for rescue in (False, True):
+            if not rescue or operator[5]:
+                free.setdefault((operator[4], rescue), []).append(operator)
+    for pool in free.values():
+        rng.shuffle(pool)
+
+    drone_rows = []
+    for id in xrange(1, spec.drones + 1):
+        class_type = 2 if rng.random() < spec.class_two else 1
+        rescue = int(rng.random() < spec.rescue)
+        map_name = rng.choice(map_rows)[0] if map_rows else None
+        operator_id = None
+        if rng.random() < spec.allocated:
+            pool = free.get((class_type, bool(rescue)), [])
+            while pool and pool[-1][7] is not None:
+                pool.pop()
+            if pool:
+                operator = pool.pop()
+                operator[7] = id
+                operator_id = operator[0]
+        drone_rows.append((id, 'Drone %d' % id, class_type, rescue, operator_id, map_name))
+
+    return drone_rows, [tuple(operator) for operator in operators], map_rows
+
+
+def fill_backend(backend, spec, map_directory=None):
+    """ Writes a generated fleet into a storage backend, with the map files in map_directory if
+    it is given. """
+    drone_rows, operator_rows, map_rows = generate_fleet(spec)
+    if map_directory is not None:
+        map_rows = [(name, os.path.join(map_directory, filepath)) for name, filepath in map_rows]
+    backend.write_maps(map_rows)
+    backend.write([], drone_rows, operator_rows)
+    return drone_rows, operator_rows, map_rows
@@ -0,0 +1,232 @@
+import os
+
+import numpy as np
+
+# Default number of positions kept in memory for each drone
+HISTORY_CAPACITY = 256
+
+# Layout of each position written to the history file
+RECORD_DTYPE = np.dtype([('drone_id', '<i4'), ('time', '<f8'), ('x', '<f4'), ('y', '<f4')])
+
+# Layout of each block listed in the index file kept next to the history file
+BLOCK_DTYPE = np.dtype([('drone_id', '<i4'), ('offset', '<i8'), ('length', '<i8'),
+                        ('first', '<f8'), ('last', '<f8')])
+
+# Size (in bytes) past which the history file is moved aside when it is opened, so a new one is
+# started
+HISTORY_MAX_BYTES = 512 * 1024 * 1024
+
+
+class PositionHistory(object):
+    ''' Keeps the timestamped positions of every tracked drone.
+
+    Each fleet slot has a fixed-size ring buffer of recent positions. When a file is given, a
+    full ring is appended to it as one block, so the file holds the complete trajectories and
+    can be memory-mapped for queries. Without a file only the latest positions are kept.
+
+    The blocks are listed in an index file next to the history file, so opening it does not
+    read the positions. A history file larger than max_bytes is moved aside to path.1 when it
+    is opened, replacing the one before. '''
+
+    def __init__(self, fleet, capacity=HISTORY_CAPACITY, path=None, max_bytes=HISTORY_MAX_BYTES):
+        self._fleet = fleet
+        self.capacity = capacity
+        self.path = path
+        self.max_bytes = max_bytes
+        rows = len(fleet.x)
+        self._times = np.zeros((rows, capacity), dtype=np.float64)
+        self._x = np.zeros((rows, capacity), dtype=np.float32)
+        self._y = np.zeros((rows, capacity), dtype=np.float32)
+        # Number of positions ever recorded for each slot, and the number held in memory that
+        # have not been written to the file yet
+        self._counts = np.zeros(rows, dtype=np.int64)
+        self._held = np.zeros(rows, dtype=np.int64)
+
+        # Blocks of the file holding each drone's positions, as (offset, length, first time,
+        # last time) in record units
+        self._blocks = {}
+        self._file = None
+        self._index_file = None
+        self._records = 0
+        self._mapped = None
+        if path is not None:
+            self._open(path)
+
+    def record(self, slots, time):
+        ''' Records the current positions of the given fleet slots at a time. '''
+        slots = np.asarray(slots, dtype=np.intp)
+        if len(slots) == 0:
+            return
+        if len(self._counts) < len(self._fleet.x):
+            self._grow(len(self._fleet.x))
+        if self._file is not None:
+            index = self._held[slots]
+        else:
+            index = self._counts[slots] % self.capacity
+        self._times[slots, index] = time
+        self._x[slots, index] = self._fleet.x[slots]
+        self._y[slots, index] = self._fleet.y[slots]
+        self._counts[slots] += 1
+        if self._file is not None:
+            self._held[slots] += 1
+            full = slots[self._held[slots] == self.capacity]
+            if len(full):
+                self._spill(full)
+
+    def trajectory(self, drone_id, start=None, end=None):
+        ''' Retrieves the (times, x, y) arrays of a drone's positions between two times, oldest
+        first. '''
+        parts = []
+        for offset, length, first, last in self._blocks.get(drone_id, ()):
+            if (start is None or last >= start) and (end is None or first <= end):
+                block = self._map()[offset:offset + length]
+                parts.append((block['time'], block['x'], block['y']))
+        slot = self._fleet.slot(drone_id)
+        if slot is not None and slot < len(self._counts):
+            parts.append(self._recent(slot))
+
+        if not parts:
+            return (np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.float32),
+                    np.zeros(0, dtype=np.float32))
+        times, x, y = [np.concatenate(column) for column in zip(*parts)]
+        keep = np.ones(len(times), dtype=np.bool_)
+        if start is not None:
+            keep &= times >= start
+        if end is not None:
+            keep &= times <= end
+        return times[keep], x[keep], y[keep]
+
+    def time_range(self):
+        ''' Returns the (first, last) times recorded, or None if nothing has been recorded. '''
+        firsts = [blocks[0][2] for blocks in self._blocks.itervalues()]
+        lasts = [blocks[-1][3] for blocks in self._blocks.itervalues()]
+        recorded = self._counts > 0
+        if recorded.any():
+            times = self._times[recorded]
+            firsts.append(times[times > 0].min())
+            lasts.append(times.max())
+        if not firsts:
+            return None
+        return min(firsts), max(lasts)
+
+    def close(self):
+        ''' Writes the positions still in memory to the file and closes it. '''
+        if self._file is not None:
+            partial = np.flatnonzero(self._held)
+            if len(partial):
+                self._spill(partial)
+            self._file.close()
+            self._file = None
+            self._index_file.close()
+            self._index_file = None
+            self._mapped = None
+            # Everything is in the file now
+            self._counts[:] = 0
+
+    def _recent(self, slot):
+        ''' Returns the positions of a slot held in memory and not yet in the file. '''
+        count = self._counts[slot]
+        if self._file is not None:
+            # The ring is written out whenever it fills, so it always starts at index 0
+            order = np.arange(self._held[slot])
+        elif count <= self.capacity:
+            order = np.arange(count)
+        else:
+            order = np.roll(np.arange(self.capacity), -(count % self.capacity))
+        return self._times[slot, order], self._x[slot, order], self._y[slot, order]
+
+    def _spill(self, slots):
+        ''' Appends the positions held in memory for the given slots to the file. '''
+        held = self._held[slots]
+        # Each slot's positions are at the start of its ring, so they come out in order
+        mask = np.arange(self.capacity) < held[:, np.newaxis]
+        records = np.empty(int(held.sum()), dtype=RECORD_DTYPE)
+        records['drone_id'] = np.repeat(self._fleet.drone_ids[slots], held)
+        records['time'] = self._times[slots][mask]
+        records['x'] = self._x[slots][mask]
+        records['y'] = self._y[slots][mask]
+        records.tofile(self._file)
+        self._file.flush()
+
+        blocks = np.empty(len(slots), dtype=BLOCK_DTYPE)
+        blocks['drone_id'] = self._fleet.drone_ids[slots]
+        blocks['offset'] = self._records + np.concatenate(([0], np.cumsum(held)[:-1]))
+        blocks['length'] = held
+        blocks['first'] = self._times[slots, 0]
+        blocks['last'] = self._times[slots, held - 1]
+        # The index is written after the positions, so it never lists a block not in the file
+        blocks.tofile(self._index_file)
+        self._index_file.flush()
+        self._add_blocks(blocks)
+        self._records += len(records)
+        self._held[slots] = 0
+
+    def _open(self, path):
+        ''' Opens the history file for appending, reading the index of the blocks it already
+        holds. '''
+        index_path = path + '.index'
+        if os.path.exists(path) and os.path.getsize(path) > self.max_bytes:
+            for name in (path, index_path):
+                if os.path.exists(name + '.1'):
+                    os.remove(name + '.1')
+                if os.path.exists(name):
+                    os.rename(name, name + '.1')
+
+        records = os.path.getsize(path) // RECORD_DTYPE.itemsize if os.path.exists(path) else 0
+        blocks = np.zeros(0, dtype=BLOCK_DTYPE)
+        if os.path.exists(index_path):
+            count = os.path.getsize(index_path) // BLOCK_DTYPE.itemsize
+            blocks = np.fromfile(index_path, dtype=BLOCK_DTYPE, count=count)
+        # Drop any block past the end of a history file cut short by a crash
+        blocks = blocks[blocks['offset'] + blocks['length'] <= records]
+        indexed = int((blocks['offset'] + blocks['length']).max()) if len(blocks) else 0
+        if indexed < records:
+            # Only the positions written after the index was last updated are read
+            blocks = np.concatenate((blocks, self._scan(path, indexed, records)))
+        self._add_blocks(blocks)
+        self._records = records
+
+        self._file = open(path, 'ab')
+        # Drop any record cut short by a crash
+        self._file.truncate(records * RECORD_DTYPE.itemsize)
+        self._index_file = open(index_path, 'wb')
+        blocks.tofile(self._index_file)
+        self._index_file.flush()
+
+    def _scan(self, path, start, end):
+        ''' Lists the blocks of the history file between two record offsets. '''
+        existing = np.memmap(path, dtype=RECORD_DTYPE, mode='r',
+                             offset=start * RECORD_DTYPE.itemsize, shape=(end - start,))
+        ids = existing['drone_id']
+        starts = np.concatenate(([0], np.flatnonzero(ids[1:] != ids[:-1]) + 1))
+        ends = np.append(starts[1:], len(ids))
+        blocks = np.empty(len(starts), dtype=BLOCK_DTYPE)
+        blocks['drone_id'] = ids[starts]
+        blocks['offset'] = start + starts
+        blocks['length'] = ends - starts
+        blocks['first'] = existing['time'][starts]
+        blocks['last'] = existing['time'][ends - 1]
+        return blocks
+
+    def _add_blocks(self, blocks):
+        for drone_id, offset, length, first, last in blocks.tolist():
+            self._blocks.setdefault(drone_id, []).append((offset, length, first, last))
+
+    def _map(self):
+        ''' Returns the history file as a memory-mapped record array. '''
+        if self._mapped is None or len(self._mapped) != self._records:
+            self._mapped = np.memmap(self.path, dtype=RECORD_DTYPE, mode='r',
+                                     shape=(self._records,))
+        return self._mapped
+
+    def _grow(self, rows):
+        for name in ('_times', '_x', '_y'):
+            old = getattr(self, name)
+            new = np.zeros((rows, self.capacity), dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        for name in ('_counts', '_held'):
+            old = getattr(self, name)
+            new = np.zeros(rows, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
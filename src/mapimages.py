@@ -0,0 +1,125 @@
+import os
+import sys
+from collections import OrderedDict
+
+import Tkinter as tk
+
+# Decoded images use roughly four bytes per pixel
+BYTES_PER_PIXEL = 4
+
+# Default memory budget for the decoded map images and tiles
+CACHE_BYTES = 256 * 1024 * 1024
+
+# Default width and height of the tiles cut from a large map
+TILE_SIZE = 512
+
+# Name of the file in a tile directory describing the tiled map
+TILE_LAYOUT = 'layout.txt'
+
+
+def tile_directory(filepath):
+    """ Returns the directory that holds the tiles for a map image. """
+    return os.path.splitext(filepath)[0] + '.tiles'
+
+
+class MapImageCache(object):
+    """ Keeps decoded map images, evicting the least recently used ones when over budget. """
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self._bytes = 0
+
+    def load_map(self, filepath):
+        """ Retrieves a map image - a TiledMap if the map has been cut into tiles, otherwise the
+        whole decoded image. """
+        directory = tile_directory(filepath)
+        if os.path.exists(os.path.join(directory, TILE_LAYOUT)):
+            return TiledMap(self, directory)
+        return self.load(filepath)
+
+    def load(self, filepath):
+        """ Retrieves a decoded image, reading it from disk if it is not cached. """
+        if filepath in self._images:
+            # Move the image to the most recently used end
+            image = self._images.pop(filepath)
+            self._images[filepath] = image
+            return image
+
+        image = tk.PhotoImage(file=filepath)
+        self._images[filepath] = image
+        self._bytes += self._cost(image)
+        while self._bytes > self.max_bytes and len(self._images) > 1:
+            oldest, evicted = self._images.popitem(last=False)
+            self._bytes -= self._cost(evicted)
+        return image
+
+    def _cost(self, image):
+        return image.width() * image.height() * BYTES_PER_PIXEL
+
+
+class TiledMap(object):
+    """ A large map image stored as tiles - only the tiles in view are decoded and drawn. """
+
+    def __init__(self, cache, directory):
+        self._cache = cache
+        self._directory = directory
+        with open(os.path.join(directory, TILE_LAYOUT)) as layout:
+            values = layout.read().split()
+        self._width, self._height, self._tile_size = [int(value) for value in values]
+        self._drawn = {}
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+    def draw(self, canvas, x0, y0, x1, y1, tag):
+        """ Draws the tiles overlapping the given canvas area and removes those out of view. """
+        size = self._tile_size
+        last_row = (self._height - 1) // size
+        last_column = (self._width - 1) // size
+        visible = set()
+        for row in xrange(max(int(y0) // size, 0), min(int(y1) // size, last_row) + 1):
+            for column in xrange(max(int(x0) // size, 0), min(int(x1) // size, last_column) + 1):
+                visible.add((row, column))
+
+        for key in [key for key in self._drawn if not key in visible]:
+            canvas.delete(self._drawn.pop(key)[0])
+        for row, column in visible:
+            if not (row, column) in self._drawn:
+                image = self._cache.load(os.path.join(self._directory, '%d_%d.gif' % (row, column)))
+                item = canvas.create_image(column * size, row * size, image=image,
+                                           anchor=tk.NW, tags=tag)
+                # Keep the image referenced while it is drawn, even if the cache evicts it
+                self._drawn[(row, column)] = (item, image)
+        canvas.tag_lower(tag)
+
+
+def make_tiles(filepath, tile_size=TILE_SIZE):
+    """ Cuts a map image into tiles that the map viewer loads on demand. """
+    root = tk.Tk()
+    root.withdraw()
+    image = tk.PhotoImage(file=filepath)
+    directory = tile_directory(filepath)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for row in xrange((image.height() + tile_size - 1) // tile_size):
+        for column in xrange((image.width() + tile_size - 1) // tile_size):
+            x0 = column * tile_size
+            y0 = row * tile_size
+            x1 = min(x0 + tile_size, image.width())
+            y1 = min(y0 + tile_size, image.height())
+            image.write(os.path.join(directory, '%d_%d.gif' % (row, column)),
+                        format='gif', from_coords=(x0, y0, x1, y1))
+    with open(os.path.join(directory, TILE_LAYOUT), 'w') as layout:
+        layout.write('%d %d %d\n' % (image.width(), image.height(), tile_size))
+    root.destroy()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: python mapimages.py <map image> [tile size]')
+        sys.exit(1)
+    make_tiles(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else TILE_SIZE)
@@ -1,3 +1,7 @@
+from backends import LOAD_BATCH_SIZE
+from metrics import timed
+
+
 class Map(object):
     """ Stores details on a map. """
 
@@ -8,20 +12,31 @@ class Map(object):
 class MapStore(object):
     """ MapStore stores all the maps for DALSys. """
 
-    def __init__(self, conn=None):
+    def __init__(self, backend=None):
         self._maps = {}
-        self._conn = conn
-        if conn != None:
+        self._backend = backend
+        if backend != None:
             self.fill_from_db()
 
-    def fill_from_db(self):
-        cursor = self._conn.cursor()
-        cursor.execute("SELECT * FROM map")
-        result = cursor.fetchall()
-        for line in result:
-            new_map = Map(line[1], line[2])
+    @timed('maps.fill_from_db')
+    def fill_from_db(self, batch_size=LOAD_BATCH_SIZE):
+        for rows in self._backend.load_maps(batch_size):
+            self.load_rows(rows)
+
+    def load_rows(self, rows):
+        """ Adds a batch of rows loaded from the database. """
+        for line in rows:
+            new_map = Map(line[0], line[1])
             self.add(new_map)
 
+    def apply_changes(self, rows):
+        """ Applies maps added or changed in the database since they were loaded. """
+        for line in rows:
+            if line[0] in self._maps:
+                self._maps[line[0]].filepath = line[1]
+            else:
+                self.add(Map(line[0], line[1]))
+
     def add(self, map):
         """ Adds a new map to the store. """
         if map.name in self._maps:
@@ -48,6 +63,11 @@ class MapStore(object):
         for key, value in self._maps.iteritems():
             yield value
 
+    def list_rows(self):
+        """ Lists the database row of every map. """
+        for map in self._maps.itervalues():
+            yield (map.name, map.filepath)
+
     def save(self):
         """ Saves the store to the database. """
         pass    # TODO: we don't have a database yet
@@ -0,0 +1,196 @@
+import functools
+import json
+import os
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from timeit import default_timer
+
+# Upper bounds (in seconds) of the latency histogram buckets - slower calls go in a last bucket
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class Stat(object):
+    """ Counts the calls of one operation, with their total and longest time, a histogram of
+    their latencies and the rows they moved. """
+
+    __slots__ = ('count', 'total', 'max', 'rows', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds, rows):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.rows += rows
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def percentile(self, fraction):
+        """ Returns the upper bound of the bucket holding a fraction of the calls, or None if it
+        is the last bucket. """
+        needed = fraction * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= needed:
+                return bound
+        return None
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95),
+                'rows': self.rows,
+                'histogram': zip(LATENCY_BUCKETS + (None,), self.buckets)}
+
+
+class Metrics(object):
+    """ Records how often operations run and how long they take. Nothing is recorded until
+    enabled is set, so the timed code only pays for one check when it is off. Operations can be
+    recorded on any thread. """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def observe(self, name, seconds, rows=0):
+        """ Records one call of an operation. """
+        with self._lock:
+            stat = self._stats.get(name)
+            if stat is None:
+                stat = self._stats[name] = Stat()
+            stat.add(seconds, rows)
+
+    def count(self, name, rows=0):
+        """ Records one call of an operation that is not timed. """
+        self.observe(name, 0.0, rows)
+
+    @contextmanager
+    def timer(self, name):
+        """ Times the code inside the block as one call of an operation. """
+        if not self.enabled:
+            yield
+            return
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.observe(name, default_timer() - start)
+
+    def get(self, name):
+        """ Returns the statistics of an operation as a dictionary, or None if it has not run. """
+        with self._lock:
+            stat = self._stats.get(name)
+            return stat.as_dict() if stat is not None else None
+
+    def snapshot(self):
+        """ Returns the statistics of every operation, keyed by name. """
+        with self._lock:
+            return dict((name, stat.as_dict()) for name, stat in self._stats.iteritems())
+
+    def reset(self):
+        """ Forgets everything recorded so far. """
+        with self._lock:
+            self._stats = {}
+
+    def report(self):
+        """ Returns the statistics as text, one operation per line, slowest in total first. """
+        stats = sorted(self.snapshot().iteritems(), key=lambda item: -item[1]['total'])
+        lines = ['%-32s %8s %10s %10s %10s %10s' % ('operation', 'count', 'total', 'mean', 'max',
+                                                    'rows')]
+        for name, stat in stats:
+            lines.append('%-32s %8d %9.3fs %9.5fs %9.5fs %10d' % (
+                name, stat['count'], stat['total'], stat['mean'], stat['max'], stat['rows']))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """ Writes the statistics to a JSON file. """
+        temp_path = path + '.new'
+        with open(temp_path, 'w') as metrics_file:
+            json.dump(self.snapshot(), metrics_file, indent=2, sort_keys=True)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+
+
+# The metrics recorded by the stores, backends and windows
+metrics = Metrics()
+
+
+def timed(name, rows=None):
+    """ Decorates a function so each call is recorded as an operation. rows, if given, is
+    called with the function's arguments to count the rows it handles. """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return function(*args, **kwargs)
+            # Counted first, as the call may consume what is being counted
+            count = rows(*args, **kwargs) if rows is not None else 0
+            start = default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.observe(name, default_timer() - start, count)
+        return wrapper
+    return decorate
+
+
+class InstrumentedCursor(object):
+    """ Wraps a database cursor, recording the time each statement takes and the rows it
+    writes or fetches. Statements found in names are recorded under their name there, and
+    others under their first word. """
+
+    def __init__(self, cursor, prefix='sql', names=None):
+        self._cursor = cursor
+        self._prefix = prefix
+        self._names = names or {}
+
+    def execute(self, sql, *args):
+        start = default_timer()
+        try:
+            return self._cursor.execute(sql, *args)
+        finally:
+            metrics.observe(self._name(sql), default_timer() - start,
+                            max(self._cursor.rowcount, 0))
+
+    def executemany(self, sql, params):
+        params = list(params)
+        start = default_timer()
+        try:
+            return self._cursor.executemany(sql, params)
+        finally:
+            metrics.observe(self._name(sql), default_timer() - start, len(params))
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone, lambda row: 0 if row is None else 1)
+
+    def fetchmany(self, *args):
+        return self._fetch(lambda: self._cursor.fetchmany(*args), len)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall, len)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _fetch(self, fetch, count):
+        start = default_timer()
+        result = fetch()
+        metrics.observe(self._prefix + '.fetch', default_timer() - start, count(result))
+        return result
+
+    def _name(self, sql):
+        name = self._names.get(sql)
+        if name is None:
+            name = sql.split(None, 1)[0].lower()
+        return '%s.%s' % (self._prefix, name)
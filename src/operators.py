@@ -1,8 +1,22 @@
 from datetime import date
 
+from backends import LOAD_BATCH_SIZE, IdAllocator
+from metrics import timed
+from sharedvalues import SharedValues
+from unitofwork import UnitOfWork, operator_row
+
+
+def join_names(first_name, family_name):
+    """ Returns the full name made from a first and family name. """
+    return '%s %s' % (first_name, family_name)
+
+
 class Operator(object):
     """ Stores details on an operator. """
 
+    __slots__ = ('id', 'first_name', 'family_name', 'date_of_birth', 'drone_license',
+                 'rescue_endorsement', 'operations', 'drone', '_saved')
+
     def __init__(self):
         self.id = -1
         self.first_name = None
@@ -12,11 +26,19 @@ class Operator(object):
         self.rescue_endorsement = False
         self.operations = 0
         self.drone = None
+        # The database row as last loaded or written, or None if the operator has not been saved
+        self._saved = None
+
+    def full_name(self):
+        """ Returns the operator's first and family names. """
+        return join_names(self.first_name, self.family_name)
 
 
 class OperatorAction(object):
     """ A pending action on the OperatorStore. """
 
+    __slots__ = ('operator', 'messages', '_commit_action', '_committed')
+
     def __init__(self, operator, commit_action):
         self.operator = operator
         self.messages = []
@@ -43,27 +65,102 @@ class OperatorAction(object):
 class OperatorStore(object):
     """ Stores the operators. """
 
-    def __init__(self, conn=None):
+    def __init__(self, backend=None, unit_of_work=None, load=True):
         self._operators = {}
+        # Rows loaded from the database that have not been turned into Operators yet
+        self._rows = {}
         self._last_id = 0
-        self._conn = conn
-        if conn != None:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM operator")
-            result = cursor.fetchall()
-            for line in result:
-                self._last_id += 1
-                new_op = Operator()
-                new_op.id = int(line[0])
-                new_op.first_name = line[1]
-                new_op.family_name = line[2]
-                new_op.date_of_birth = line[3]
-                new_op.drone_license = int(line[4])
-                new_op.rescue_endorsement = int(line[5])
-                new_op.operations = int(line[6])
-                new_op.drone = line[7]
-                self._operators[new_op.id] = new_op
+        self._backend = backend
+        # New operators take IDs reserved from the database, so other instances cannot reuse them
+        self._ids = IdAllocator(backend, 'operator') if backend is not None else None
+        # Secondary index: full name -> operator IDs, plus the name each operator is
+        # currently indexed under so it can be moved when the operator is renamed
+        self._name_index = {}
+        self._indexed_names = {}
+        # Eligibility index: (license, rescue endorsement, free) -> operator IDs, plus the key
+        # each operator is currently indexed under
+        self._eligibility_index = {}
+        self._indexed_eligibility = {}
+        # One shared copy of each first name, family name and date of birth held by the loaded rows
+        self._values = SharedValues((1, 2, 3))
+        if unit_of_work is None and backend != None:
+            unit_of_work = UnitOfWork(backend)
+        self._unit_of_work = unit_of_work
+        # Without load, the store only holds the operators added to it
+        if backend != None and load:
+            self.fill_from_db()
+
+    @timed('operators.fill_from_db')
+    def fill_from_db(self, batch_size=LOAD_BATCH_SIZE):
+        """ Loads the operators from the database in batches - each Operator is only created
+        when it is first used. """
+        for rows in self._backend.load_operators(batch_size):
+            self.load_rows(rows)
+
+    @timed('operators.load_rows', rows=lambda self, rows: len(rows))
+    def load_rows(self, rows):
+        """ Adds a batch of rows loaded from the database. """
+        for row in rows:
+            id = int(row[0])
+            row = self._values.share(row)
+            if id in self._rows:
+                self._values.release(self._rows[id])
+            self._rows[id] = row
+            self._index_record(id, join_names(row[1], row[2]), row[4], row[5], row[7])
+            self._last_id = max(self._last_id, id)
 
+    @timed('operators.hydrate')
+    def _hydrate(self, id):
+        """ Creates the Operator for a row loaded from the database. """
+        line = self._rows.pop(id)
+        self._values.release(line)
+        new_op = Operator()
+        new_op.id = id
+        new_op.first_name = line[1]
+        new_op.family_name = line[2]
+        new_op.date_of_birth = line[3]
+        new_op.drone_license = int(line[4])
+        new_op.rescue_endorsement = int(line[5])
+        new_op.operations = int(line[6])
+        new_op.drone = line[7]
+        new_op._saved = operator_row(new_op)
+        self._operators[id] = new_op
+        return new_op
+
+    @timed('operators.apply_changes', rows=lambda self, rows: len(rows))
+    def apply_changes(self, rows):
+        """ Applies operators changed in the database since they were loaded. Operators with
+        changes of their own still to be saved are left as they are. Returns the IDs of the
+        operators changed. """
+        changed = []
+        for row in rows:
+            id = int(row[0])
+            if self._unit_of_work is not None and \
+                    self._unit_of_work.state('operator', id) is not None:
+                continue
+            if id in self._operators:
+                operator = self._operators[id]
+                if operator_row(operator) == tuple(row):
+                    continue
+                # Update the operator in place, so anything holding it sees the change
+                operator.first_name = row[1]
+                operator.family_name = row[2]
+                operator.date_of_birth = row[3]
+                operator.drone_license = int(row[4])
+                operator.rescue_endorsement = int(row[5])
+                operator.operations = int(row[6])
+                operator.drone = row[7]
+                operator._saved = operator_row(operator)
+                self._index_record(id, operator.full_name(), operator.drone_license,
+                                   operator.rescue_endorsement, operator.drone)
+            elif self._rows.get(id) == tuple(row):
+                continue
+            else:
+                self.load_rows([row])
+            changed.append(id)
+        return changed
+
+    @timed('operators.add')
     def add(self, operator):
         """ Starts adding a new operator to the store. """
         action = OperatorAction(operator, self._add)
@@ -90,53 +187,159 @@ class OperatorStore(object):
 
     def _add(self, operator):
         """ Adds a new operator to the store. """
-        if operator.id in self._operators:
+        if operator.id in self._operators or operator.id in self._rows:
             raise Exception('Operator already exists in store')
         else:
-            self._last_id += 1
-            operator.id = self._last_id
+            operator.id = self._ids.next_id() if self._ids is not None else self._last_id + 1
+            self._last_id = max(self._last_id, operator.id)
             self._operators[operator.id] = operator
             self.save(operator)
 
+    @timed('operators.remove')
     def remove(self, operator):
         """ Removes a operator from the store. """
+        if operator.id in self._rows:
+            self._hydrate(operator.id)
         if not operator.id in self._operators:
             raise Exception('Operator does not exist in store')
         else:
             del self._operators[operator.id]
+            self._unindex(operator.id)
 
     def get(self, id):
         """ Retrieves a operator from the store by its ID or name. """
         if isinstance(id, basestring):
-            for op in self._operators.values():
-                if (op.first_name + ' ' + op.family_name) == id:
-                    return op
-            return None
+            operators = self.find_by_name(id)
+            if len(operators) > 1:
+                raise Exception('More than one operator is named %s' % id)
+            elif len(operators) == 0:
+                return None
+            else:
+                return operators[0]
         else:
+            if id in self._rows:
+                self._hydrate(id)
             if not id in self._operators:
                 return None
             else:
                 return self._operators[id]
 
+    def find_by_name(self, name):
+        """ Retrieves all the operators with the given full name. """
+        return [self.get(id) for id in self._name_index.get(name, ())]
+
+    def list_ids(self):
+        """ Lists the IDs of all the operators in the system, in ID order. """
+        return sorted(self._operators.keys() + self._rows.keys())
+
+    def list_names(self):
+        """ Lists the distinct full names of the operators in the system. """
+        return self._name_index.keys()
+
+    @timed('operators.find_eligible')
+    def find_eligible(self, drone):
+        """ Retrieves the free operators who can fly a drone under the allocation rules. """
+        return [self.get(id) for id in self._eligible_ids(drone)]
+
+    def list_eligible_names(self, drone):
+        """ Lists the distinct full names of the free operators who can fly a drone. """
+        return list(set(self._indexed_names[id] for id in self._eligible_ids(drone)))
+
+    def list_free(self):
+        """ Lists the operators who are not flying a drone. """
+        for (license, endorsed, free), ids in self._eligibility_index.items():
+            if free:
+                for id in list(ids):
+                    yield self.get(id)
+
+    def _eligible_ids(self, drone):
+        index = self._eligibility_index
+        ids = list(index.get((drone.class_type, True, True), ()))
+        if not drone.rescue:
+            ids.extend(index.get((drone.class_type, False, True), ()))
+        return ids
+
+    def list_rows(self):
+        """ Lists the database row of every operator, without loading the operators. """
+        for row in self._rows.itervalues():
+            yield row
+        for operator in self._operators.itervalues():
+            yield operator_row(operator)
+
     def list_all(self):
         """ Lists all the _operators in the system. """
-        for key, value in self._operators.iteritems():
-            yield value
+        for id in self.list_ids():
+            yield self.get(id)
 
+    @timed('operators.save')
     def save(self, operator):
-        """ Saves the store to the database. """
-        cursor = self._conn.cursor()
-        sql_str = "SELECT * FROM operator WHERE operator_id = %d;" % operator.id
-        cursor.execute(sql_str)
-        if cursor.fetchone() == None:
-            # This will run if the operator is not already in the database (adding a new operator)
-            sql_str = "INSERT INTO operator () VALUES(%d, \"%s\", \"%s\", NULL, 0, 0, 0, NULL);"% (operator.id, operator.first_name, operator.family_name)
-            cursor.execute(sql_str)
-            self._conn.commit()
-        else:
-            if operator.drone == None:
-                sql_str = "UPDATE operator SET first_name = \"%s\", family_name = \"%s\", drone_license = %d, rescue_endorsement = %d, operations = %d WHERE operator_id = %d;" % (operator.first_name, operator.family_name, operator.drone_license, operator.rescue_endorsement, operator.operations, operator.id)
-            else:
-                sql_str = "UPDATE operator SET first_name = \"%s\", family_name = \"%s\", drone_license = %d, rescue_endorsement = %d, operations = %d, drone_id = %d WHERE operator_id = %d;" % (operator.first_name, operator.family_name, operator.drone_license, operator.rescue_endorsement, operator.operations, operator.drone, operator.id)
-            cursor.execute(sql_str)
-            self._conn.commit()
+        """ Records the operator as changed - it is written when the unit of work is flushed.
+        Operators that match their database row, or the row still being written, are skipped. """
+        if operator.id in self._operators:
+            self._index_record(operator.id, operator.full_name(), operator.drone_license,
+                               operator.rescue_endorsement, operator.drone)
+        if self._unit_of_work is not None and self._unit_of_work.needs_write(
+                'operator', operator, operator_row(operator)):
+            self._unit_of_work.register_operator(operator)
+
+    @timed('operators.commit_allocation')
+    def commit_allocation(self, action):
+        """ Commits a drone allocation and saves the operators it changes, so the drone, the
+        operator, the operator's previous drone and the operator released from the drone are
+        all written in one transaction. Returns the operator. """
+        if self._unit_of_work is None:
+            return self._commit_allocation(action)
+        with self._unit_of_work.transaction():
+            return self._commit_allocation(action)
+
+    def _commit_allocation(self, action):
+        released_id = action.drone.operator
+        operator = action.commit()
+        if released_id is not None and released_id != operator.id:
+            # The operator who flew the drone before must not keep pointing at it
+            released = self.get(released_id)
+            if released is not None and released.drone == action.drone.id:
+                released.drone = None
+                self.save(released)
+        self.save(operator)
+        return operator
+
+    @timed('operators.commit_plan')
+    def commit_plan(self, plan):
+        """ Commits an AllocationPlan and saves the operators it changes, so every drone and
+        operator in the plan is written in one transaction. Returns the changed operators. """
+        if self._unit_of_work is None:
+            return self._commit_plan(plan)
+        with self._unit_of_work.transaction():
+            return self._commit_plan(plan)
+
+    def _commit_plan(self, plan):
+        operators = plan.commit()
+        for operator in operators:
+            self.save(operator)
+        return operators
+
+    def _index_record(self, id, name, drone_license, rescue_endorsement, drone):
+        """ Updates the secondary indexes for an operator. """
+        self._unindex(id)
+        self._name_index.setdefault(name, set()).add(id)
+        self._indexed_names[id] = name
+        if drone_license is not None:
+            key = (int(drone_license), bool(rescue_endorsement), drone is None)
+            self._eligibility_index.setdefault(key, set()).add(id)
+            self._indexed_eligibility[id] = key
+
+    def _unindex(self, id):
+        """ Removes an operator from the secondary indexes. """
+        if id in self._indexed_names:
+            name = self._indexed_names.pop(id)
+            ids = self._name_index[name]
+            ids.discard(id)
+            if not ids:
+                del self._name_index[name]
+        if id in self._indexed_eligibility:
+            key = self._indexed_eligibility.pop(id)
+            ids = self._eligibility_index[key]
+            ids.discard(id)
+            if not ids:
+                del self._eligibility_index[key]
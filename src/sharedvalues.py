@@ -0,0 +1,41 @@
+class SharedValues(object):
+    """ Keeps one shared copy of each value held in some columns of the rows a store has loaded,
+    so values repeated across many rows are only stored once. Only columns whose values repeat
+    are worth sharing, as each distinct value takes an entry here - small integers are already
+    shared by Python.
+
+    Each copy is counted against the rows holding it, and forgotten when the last of those rows
+    is released. """
+
+    def __init__(self, columns):
+        # Indexes of the shared columns in each row
+        self.columns = columns
+        # Value -> [shared copy, number of rows holding it]
+        self._values = {}
+
+    def share(self, row):
+        """ Returns the row with the values of the shared columns replaced by their shared
+        copies. """
+        row = list(row)
+        for index in self.columns:
+            value = row[index]
+            if value is not None:
+                entry = self._values.get(value)
+                if entry is None:
+                    entry = self._values[value] = [value, 0]
+                entry[1] += 1
+                row[index] = entry[0]
+        return tuple(row)
+
+    def release(self, row):
+        """ Records that a row returned by share is no longer held. """
+        for index in self.columns:
+            value = row[index]
+            entry = self._values.get(value) if value is not None else None
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._values[value]
+
+    def __len__(self):
+        return len(self._values)
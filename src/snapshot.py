@@ -0,0 +1,55 @@
+import cPickle
+import os
+
+from backends import DRONE_COLUMNS, MAP_COLUMNS, OPERATOR_COLUMNS
+
+# Changed whenever the layout of the snapshot file changes - older snapshots are ignored
+SNAPSHOT_FORMAT = 1
+
+
+def write_snapshot(path, source, version, drone_rows, operator_rows, map_rows):
+    """ Saves the rows of the stores, as they were at a database version, to a local file. """
+    header = {'format': SNAPSHOT_FORMAT,
+              'columns': (DRONE_COLUMNS, OPERATOR_COLUMNS, MAP_COLUMNS),
+              'source': source,
+              'version': version}
+    # Write to a new file first, so a crash cannot leave a half-written snapshot behind
+    temp_path = path + '.new'
+    with open(temp_path, 'wb') as snapshot_file:
+        cPickle.dump(header, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump((drone_rows, operator_rows, map_rows), snapshot_file,
+                     cPickle.HIGHEST_PROTOCOL)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+
+def read_snapshot(path, source, current_version):
+    """ Loads a snapshot as (version, drone rows, operator rows, map rows). Returns None if
+    there is no snapshot, or it was written in another format, from another database or from
+    a later version than the database is at now. """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as snapshot_file:
+            header = cPickle.load(snapshot_file)
+            if (header.get('format') != SNAPSHOT_FORMAT or
+                    header.get('columns') != (DRONE_COLUMNS, OPERATOR_COLUMNS, MAP_COLUMNS) or
+                    header.get('source') != source or
+                    header.get('version') > current_version):
+                return None
+            drone_rows, operator_rows, map_rows = cPickle.load(snapshot_file)
+    except Exception:
+        # A damaged snapshot only means a full load
+        return None
+    return header['version'], drone_rows, operator_rows, map_rows
+
+
+def merge_rows(rows, changed_rows, removed=()):
+    """ Applies changed and removed rows, keyed by their first column, to a list of rows. """
+    merged = dict((row[0], row) for row in rows)
+    for key in removed:
+        merged.pop(key, None)
+    for row in changed_rows:
+        merged[row[0]] = row
+    return merged.values()
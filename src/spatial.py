@@ -0,0 +1,109 @@
+import numpy as np
+
+
+def grid_columns(map_size, cell_size):
+    ''' Returns the number of cells along each side of a grid covering the map. '''
+    return int(map_size // cell_size) + 1
+
+
+def cell_of(x, y, cell_size, columns):
+    ''' Converts positions into the cell numbers of a square grid. '''
+    column = np.floor_divide(x, cell_size).astype(np.int64)
+    row = np.floor_divide(y, cell_size).astype(np.int64)
+    return row * columns + column
+
+
+class GridIndex(object):
+    ''' Uniform grid of the tracked drones on one map, used for region and nearest queries.
+
+    The grid stores fleet slots; positions are read from the fleet arrays when a query runs. '''
+
+    def __init__(self, fleet, map_size, cell_size):
+        self._fleet = fleet
+        self.cell_size = cell_size
+        self.columns = grid_columns(map_size, cell_size)
+        self._cells = {}
+
+    def __len__(self):
+        return sum(len(slots) for slots in self._cells.itervalues())
+
+    def add(self, slot, cell):
+        ''' Adds a fleet slot to a grid cell. '''
+        self._cells.setdefault(cell, set()).add(slot)
+
+    def remove(self, slot, cell):
+        ''' Removes a fleet slot from a grid cell. '''
+        slots = self._cells[cell]
+        slots.discard(slot)
+        if not slots:
+            del self._cells[cell]
+
+    def all_slots(self):
+        ''' Retrieves every slot in the grid. '''
+        return self._slots_in_cells(self._cells.iterkeys())
+
+    def in_rect(self, x0, y0, x1, y1):
+        ''' Retrieves the slots with a position inside the rectangle. '''
+        slots = self._slots_in_cells(self._cells_in_rect(x0, y0, x1, y1))
+        x = self._fleet.x[slots]
+        y = self._fleet.y[slots]
+        return slots[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+
+    def in_radius(self, cx, cy, radius):
+        ''' Retrieves the slots with a position within radius of a point. '''
+        slots = self._slots_in_cells(
+            self._cells_in_rect(cx - radius, cy - radius, cx + radius, cy + radius))
+        return slots[self._distances(slots, cx, cy) <= radius]
+
+    def nearest(self, cx, cy, k=1):
+        ''' Retrieves up to k slots nearest to a point, closest first. '''
+        column = int(min(max(cx // self.cell_size, 0), self.columns - 1))
+        row = int(min(max(cy // self.cell_size, 0), self.columns - 1))
+        found = []
+        ring = 0
+        while ring < self.columns:
+            found.extend(self._slots_in_ring(column, row, ring))
+            # Anything in a cell outside this ring is at least ring cells away from the point
+            if len(found) >= k:
+                slots = np.array(found, dtype=np.intp)
+                distances = self._distances(slots, cx, cy)
+                if np.sort(distances)[k - 1] <= ring * self.cell_size:
+                    break
+            ring += 1
+
+        slots = np.array(found, dtype=np.intp)
+        order = np.argsort(self._distances(slots, cx, cy), kind='mergesort')
+        return slots[order[:k]]
+
+    def _distances(self, slots, cx, cy):
+        return np.hypot(self._fleet.x[slots] - cx, self._fleet.y[slots] - cy)
+
+    def _cells_in_rect(self, x0, y0, x1, y1):
+        last = self.columns - 1
+        c0 = int(min(max(x0 // self.cell_size, 0), last))
+        c1 = int(min(max(x1 // self.cell_size, 0), last))
+        r0 = int(min(max(y0 // self.cell_size, 0), last))
+        r1 = int(min(max(y1 // self.cell_size, 0), last))
+        for row in xrange(r0, r1 + 1):
+            for column in xrange(c0, c1 + 1):
+                yield row * self.columns + column
+
+    def _slots_in_ring(self, column, row, ring):
+        ''' Retrieves the slots in the cells exactly ring cells away from (column, row). '''
+        for r in xrange(row - ring, row + ring + 1):
+            if r < 0 or r >= self.columns:
+                continue
+            if ring == 0 or r == row - ring or r == row + ring:
+                columns = xrange(column - ring, column + ring + 1)
+            else:
+                columns = (column - ring, column + ring)
+            for c in columns:
+                if 0 <= c < self.columns:
+                    for slot in self._cells.get(r * self.columns + c, ()):
+                        yield slot
+
+    def _slots_in_cells(self, cells):
+        slots = []
+        for cell in cells:
+            slots.extend(self._cells.get(cell, ()))
+        return np.array(slots, dtype=np.intp)
@@ -0,0 +1,154 @@
+import Queue
+import threading
+from ConfigParser import SafeConfigParser
+from contextlib import contextmanager
+from timeit import default_timer
+
+from backends import LOAD_BATCH_SIZE
+
+# How often (in milliseconds) the Tk thread adds the loaded rows to the stores
+POLL_INTERVAL = 20
+
+# Longest time (in seconds) the Tk thread spends adding rows before it handles events again
+APPLY_BUDGET = 0.05
+
+
+class StartupTimer(object):
+    """ Records how long each phase of startup takes. Phases can be timed on any thread. """
+
+    def __init__(self):
+        self._start = default_timer()
+        self._lock = threading.Lock()
+        self._phases = []
+        self._times = {}
+
+    def add(self, phase, seconds):
+        """ Adds time to a phase. """
+        with self._lock:
+            if not phase in self._times:
+                self._phases.append(phase)
+                self._times[phase] = 0.0
+            self._times[phase] += seconds
+
+    @contextmanager
+    def phase(self, phase):
+        """ Times the code inside the block as part of a phase. """
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add(phase, default_timer() - start)
+
+    def elapsed(self):
+        """ Returns the time since startup began, in seconds. """
+        return default_timer() - self._start
+
+    def phases(self):
+        """ Lists the (phase, seconds) pairs in the order the phases began. """
+        with self._lock:
+            return [(phase, self._times[phase]) for phase in self._phases]
+
+    def report(self):
+        """ Returns the timings as text, one phase per line. """
+        lines = ['%-20s %8.3fs' % (phase, seconds) for phase, seconds in self.phases()]
+        return '\n'.join(lines)
+
+
+def show_timings_from_config(path):
+    """ Returns True if the [startup] section of a configuration file asks for the startup
+    timings to be printed. """
+    config = SafeConfigParser()
+    config.read(path)
+    if not config.has_option('startup', 'show_timings') or \
+            not config.get('startup', 'show_timings'):
+        return False
+    return config.getboolean('startup', 'show_timings')
+
+
+class StoreLoader(object):
+    """ Loads the stores on background threads, each with its own backend connection. The rows
+    are handed back to the Tk thread in batches, so the window stays responsive while they are
+    added to the stores. """
+
+    def __init__(self, connect, timer, root=None, batch_size=LOAD_BATCH_SIZE):
+        self._connect = connect
+        self._timer = timer
+        self._root = root
+        self.batch_size = batch_size
+        self._batches = Queue.Queue()
+        self._handlers = {}
+        if root is not None:
+            root.after(POLL_INTERVAL, self._poll)
+
+    def load(self, name, load_rows, on_rows, on_done=None):
+        """ Starts loading rows with load_rows(backend, batch_size) on a new thread. on_rows is
+        called with each batch, then on_done with None or the error that stopped the load, on
+        the Tk thread. """
+        self._handlers[name] = (on_rows, on_done)
+        thread = threading.Thread(target=self._run, args=(name, load_rows),
+                                  name='StoreLoader-%s' % name)
+        thread.daemon = True
+        thread.start()
+
+    def add(self, name, rows, on_rows, on_done=None):
+        """ Queues rows that are already in memory, such as those read from a snapshot, to be
+        handed to on_rows in batches like the loaded rows. """
+        self._handlers[name] = (on_rows, on_done)
+        for start in xrange(0, len(rows), self.batch_size):
+            self._batches.put((name, rows[start:start + self.batch_size], None))
+        self._batches.put((name, None, None))
+
+    def loading(self):
+        """ Lists the names of the loads that have not finished. """
+        return self._handlers.keys()
+
+    def process(self, budget=None):
+        """ Adds the fetched batches to the stores, stopping after budget seconds if given.
+        Returns True once every load has finished. """
+        start = default_timer()
+        while self._handlers:
+            if budget is not None and default_timer() - start > budget:
+                return False
+            try:
+                name, rows, error = self._batches.get_nowait()
+            except Queue.Empty:
+                return False
+            self._apply(name, rows, error)
+        return True
+
+    def finish(self):
+        """ Waits for every load to finish, adding the batches to the stores as they arrive. """
+        while self._handlers:
+            name, rows, error = self._batches.get()
+            self._apply(name, rows, error)
+
+    def _apply(self, name, rows, error):
+        on_rows, on_done = self._handlers[name]
+        if rows is not None:
+            with self._timer.phase('load %s' % name):
+                on_rows(rows)
+        else:
+            del self._handlers[name]
+            if on_done is not None:
+                on_done(error)
+
+    def _poll(self):
+        if not self.process(APPLY_BUDGET):
+            self._root.after(POLL_INTERVAL, self._poll)
+
+    def _run(self, name, load_rows):
+        error = None
+        backend = None
+        start = default_timer()
+        try:
+            with self._timer.phase('connect %s' % name):
+                backend = self._connect()
+            for rows in load_rows(backend, self.batch_size):
+                self._batches.put((name, rows, None))
+        except Exception as e:
+            error = e
+        finally:
+            if backend is not None:
+                backend.close()
+        self._timer.add('fetch %s' % name, default_timer() - start)
+        self._batches.put((name, None, error))
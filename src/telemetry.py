@@ -0,0 +1,146 @@
+import socket
+import struct
+import threading
+from ConfigParser import SafeConfigParser
+
+import numpy as np
+
+from history import RECORD_DTYPE
+
+# Port the position reports are sent to when none is configured
+TELEMETRY_PORT = 47800
+
+# Each report is a drone ID, the time it was taken and the x and y position - the same layout as
+# the position history file, so recorded history can be replayed as traffic
+REPORT_DTYPE = RECORD_DTYPE
+
+# Every datagram starts with a marker and the number of reports that follow
+HEADER = struct.Struct('<4sI')
+MAGIC = 'DRT1'
+
+# Reports sent in each datagram, which keeps them under the usual network packet size
+REPORTS_PER_DATAGRAM = 64
+
+# Most datagrams read from the socket before their reports are handed over together
+RECEIVE_BATCH = 256
+
+
+def encode_reports(reports):
+    ''' Packs an array of reports into datagrams. '''
+    reports = np.asarray(reports, dtype=REPORT_DTYPE)
+    datagrams = []
+    for start in xrange(0, len(reports), REPORTS_PER_DATAGRAM):
+        chunk = reports[start:start + REPORTS_PER_DATAGRAM]
+        datagrams.append(HEADER.pack(MAGIC, len(chunk)) + chunk.tostring())
+    return datagrams
+
+
+def decode_datagram(data):
+    ''' Unpacks the reports in a datagram, or returns None if it is not a valid datagram. '''
+    if len(data) < HEADER.size:
+        return None
+    magic, count = HEADER.unpack_from(data)
+    if magic != MAGIC or len(data) != HEADER.size + count * REPORT_DTYPE.itemsize:
+        return None
+    return np.frombuffer(data, dtype=REPORT_DTYPE, count=count, offset=HEADER.size)
+
+
+def decode_datagrams(datagrams):
+    ''' Unpacks the reports in several datagrams into one array. Returns the reports and the
+    number of datagrams that were not valid. '''
+    batches = []
+    dropped = 0
+    for data in datagrams:
+        reports = decode_datagram(data)
+        if reports is None:
+            dropped += 1
+        else:
+            batches.append(reports)
+    if not batches:
+        return np.zeros(0, dtype=REPORT_DTYPE), dropped
+    return np.concatenate(batches), dropped
+
+
+def coalesce(reports):
+    ''' Keeps only the latest report for each drone. Reports with the same time are settled by
+    the order they arrived in. '''
+    if len(reports) < 2:
+        return reports
+    order = np.lexsort((np.arange(len(reports)), reports['time'], reports['drone_id']))
+    ids = reports['drone_id'][order]
+    last = np.append(ids[1:] != ids[:-1], True)
+    return reports[order[last]]
+
+
+def telemetry_port_from_config(path):
+    ''' Returns the port set in the [telemetry] section of a configuration file, or None if
+    telemetry is not enabled. '''
+    config = SafeConfigParser()
+    config.read(path)
+    if not config.has_option('telemetry', 'port') or not config.get('telemetry', 'port'):
+        return None
+    return config.getint('telemetry', 'port')
+
+
+class TelemetryReceiver(object):
+    ''' Receives position reports on a UDP socket from a worker thread.
+
+    Reports build up until take() is called, usually once a tick on the Tk thread, which
+    returns only the latest report for each drone. '''
+
+    def __init__(self, port=TELEMETRY_PORT, host='127.0.0.1'):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # A larger buffer rides out bursts while the worker is waiting for the GIL
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self._socket.bind((host, port))
+        self._socket.settimeout(0.2)
+        # The port actually bound, in case 0 was given
+        self.port = self._socket.getsockname()[1]
+        # Counts of the reports received and the datagrams that could not be read
+        self.received = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='TelemetryReceiver')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def take(self):
+        ''' Returns the latest report for each drone received since the last call. '''
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+        if not pending:
+            return np.zeros(0, dtype=REPORT_DTYPE)
+        return coalesce(np.concatenate(pending))
+
+    def stop(self):
+        ''' Stops the worker thread and closes the socket. '''
+        self._stopped = True
+        self._thread.join()
+        self._socket.close()
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                datagrams = [self._socket.recv(65536)]
+            except socket.timeout:
+                continue
+            # Read whatever else has already arrived, so it is decoded as one batch
+            self._socket.setblocking(False)
+            try:
+                while len(datagrams) < RECEIVE_BATCH:
+                    datagrams.append(self._socket.recv(65536))
+            except socket.error:
+                pass
+            self._socket.settimeout(0.2)
+            self._add(datagrams)
+
+    def _add(self, datagrams):
+        reports, dropped = decode_datagrams(datagrams)
+        with self._lock:
+            self.dropped += dropped
+            if len(reports):
+                self.received += len(reports)
+                self._pending.append(reports)
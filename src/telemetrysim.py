@@ -0,0 +1,126 @@
+""" Sends simulated drone position reports to a running DALSys, to test telemetry ingestion.
+
+    python telemetrysim.py --drones 1000 --rate 20000 --seconds 30
+    python telemetrysim.py --drones 1000 --rate 20000 --record traffic.bin
+    python telemetrysim.py --replay traffic.bin --speed 2
+
+Recorded traffic has the same layout as the position history file, so a history file can be
+replayed as well. """
+import argparse
+import socket
+import sys
+import time
+
+import numpy as np
+
+from telemetry import REPORT_DTYPE, TELEMETRY_PORT, encode_reports
+from trackingsystem import MAP_SIZE
+
+# How often (in seconds) the simulator sends the reports that have come due
+SEND_INTERVAL = 0.01
+
+
+class Sender(object):
+    """ Sends reports to the telemetry port, keeping count of what was sent. """
+
+    def __init__(self, host, port, record_path=None):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._address = (host, port)
+        self._record = open(record_path, 'ab') if record_path else None
+        self.reports = 0
+        self.datagrams = 0
+
+    def send(self, reports):
+        for datagram in encode_reports(reports):
+            self._socket.sendto(datagram, self._address)
+            self.datagrams += 1
+        self.reports += len(reports)
+        if self._record is not None:
+            reports.tofile(self._record)
+
+    def close(self):
+        self._socket.close()
+        if self._record is not None:
+            self._record.close()
+
+
+def generate(sender, drones, first_id, rate, seconds, seed):
+    """ Sends random walk reports for a fleet at rate reports a second, taking the drones in
+    turn. """
+    rng = np.random.RandomState(seed)
+    ids = np.arange(first_id, first_id + drones, dtype=np.int32)
+    x = rng.uniform(0, MAP_SIZE, drones).astype(np.float32)
+    y = rng.uniform(0, MAP_SIZE, drones).astype(np.float32)
+    start = time.time()
+    sent = 0
+    turn = 0
+    while seconds is None or time.time() - start < seconds:
+        due = int((time.time() - start) * rate) - sent
+        if due > 0:
+            chosen = (turn + np.arange(due)) % drones
+            turn = (turn + due) % drones
+            x[chosen] = np.clip(x[chosen] + rng.uniform(-1, 1, due), 0, MAP_SIZE)
+            y[chosen] = np.clip(y[chosen] + rng.uniform(-1, 1, due), 0, MAP_SIZE)
+            reports = np.empty(due, dtype=REPORT_DTYPE)
+            reports['drone_id'] = ids[chosen]
+            reports['time'] = time.time()
+            reports['x'] = x[chosen]
+            reports['y'] = y[chosen]
+            sender.send(reports)
+            sent += due
+        time.sleep(SEND_INTERVAL)
+
+
+def replay(sender, path, speed):
+    """ Sends recorded reports with the same spacing in time they were recorded with, divided
+    by speed. The report times are moved forward to now. """
+    recorded = np.fromfile(path, dtype=REPORT_DTYPE)
+    if len(recorded) == 0:
+        return
+    recorded = recorded[np.argsort(recorded['time'], kind='mergesort')]
+    first = recorded['time'][0]
+    start = time.time()
+    sent = 0
+    while sent < len(recorded):
+        elapsed = (time.time() - start) * speed
+        end = np.searchsorted(recorded['time'], first + elapsed, side='right')
+        if end > sent:
+            reports = recorded[sent:end].copy()
+            reports['time'] += start - first
+            sender.send(reports)
+            sent = end
+        time.sleep(SEND_INTERVAL)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Send simulated drone position reports.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=TELEMETRY_PORT)
+    parser.add_argument('--drones', type=int, default=1000)
+    parser.add_argument('--first-id', type=int, default=1, help='ID of the first drone')
+    parser.add_argument('--rate', type=float, default=10000, help='reports sent each second')
+    parser.add_argument('--seconds', type=float, help='how long to run (default: until stopped)')
+    parser.add_argument('--seed', type=int, default=280)
+    parser.add_argument('--record', help='file to append the generated reports to')
+    parser.add_argument('--replay', help='file of recorded reports to send instead')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed')
+    args = parser.parse_args(argv)
+
+    sender = Sender(args.host, args.port, args.record)
+    start = time.time()
+    try:
+        if args.replay:
+            replay(sender, args.replay, args.speed)
+        else:
+            generate(sender, args.drones, args.first_id, args.rate, args.seconds, args.seed)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sender.close()
+    elapsed = time.time() - start
+    print('Sent %d reports in %d datagrams over %.1fs (%.0f reports/s)' % (
+        sender.reports, sender.datagrams, elapsed, sender.reports / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
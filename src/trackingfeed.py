@@ -0,0 +1,116 @@
+import threading
+import time
+
+import numpy as np
+
+# Default number of position batches a subscriber receives each second
+FEED_RATE = 5.0
+
+
+class PositionBatch(object):
+    ''' The positions of the drones on a map at one moment. '''
+
+    def __init__(self, time, drone_ids, positions):
+        self.time = time
+        self.drone_ids = drone_ids
+        # An (n, 2) array of x and y
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.drone_ids)
+
+
+class Subscription(object):
+    ''' Receives the positions of the drones on one map.
+
+    Only the latest batch is kept - a subscriber that falls behind skips the batches it missed
+    rather than building up a queue. '''
+
+    def __init__(self, map_id, rate):
+        self.map_id = map_id
+        self.interval = 1.0 / rate
+        self.next_time = 0.0
+        # Number of batches replaced before the subscriber took them
+        self.skipped = 0
+        # Fleet version of the last batch published
+        self.version = None
+        self._lock = threading.Lock()
+        self._latest = None
+
+    def take(self):
+        ''' Returns the latest batch, or None if there has not been a new one since the last
+        call. '''
+        with self._lock:
+            batch = self._latest
+            self._latest = None
+        return batch
+
+    def _publish(self, batch):
+        with self._lock:
+            if self._latest is not None:
+                self.skipped += 1
+            self._latest = batch
+
+
+class TrackingFeed(object):
+    ''' Publishes the drone positions to the subscriptions from a worker thread, at each
+    subscription's rate and only when the fleet has moved. '''
+
+    def __init__(self, fleet):
+        self._fleet = fleet
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='TrackingFeed')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def subscribe(self, map_id, rate=FEED_RATE):
+        ''' Starts publishing the positions on a map to a new subscription. '''
+        subscription = Subscription(map_id, rate)
+        with self._lock:
+            self._subscriptions.append(subscription)
+        self._wake.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        ''' Stops publishing to a subscription. '''
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+
+    def stop(self):
+        ''' Stops the worker thread. '''
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.clear()
+            with self._lock:
+                subscriptions = list(self._subscriptions)
+            now = time.time()
+            wait = 1.0
+            version = self._fleet.version
+            for subscription in subscriptions:
+                if subscription.next_time <= now:
+                    # Publish only if the fleet has moved since this subscription's last batch
+                    if subscription.version != version:
+                        subscription._publish(self._batch(subscription.map_id, now))
+                        subscription.version = version
+                    subscription.next_time = now + subscription.interval
+                wait = min(wait, subscription.next_time - now)
+            self._wake.wait(max(wait, 0.001))
+
+    def _batch(self, map_id, now):
+        ''' Reads the positions of the drones on a map from the fleet arrays. '''
+        fleet = self._fleet
+        # The arrays are read before the size, as the Tk thread may grow them at any time
+        drone_ids, map_ids, valid, x, y = (fleet.drone_ids, fleet.map_ids, fleet.valid,
+                                           fleet.x, fleet.y)
+        n = min(len(fleet), len(x), len(y), len(valid), len(map_ids), len(drone_ids))
+        on_map = valid[:n] & (map_ids[:n] == map_id)
+        positions = np.column_stack((x[:n][on_map], y[:n][on_map]))
+        return PositionBatch(now, drone_ids[:n][on_map], positions)
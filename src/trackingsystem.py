@@ -1,4 +1,100 @@
-import random
+import time
+
+import numpy as np
+
+from history import HISTORY_CAPACITY, PositionHistory
+from metrics import timed
+from spatial import GridIndex, cell_of, grid_columns
+from trackingfeed import FEED_RATE, TrackingFeed
+
+# Positions are reported on a 100 x 100 grid covering the map
+MAP_SIZE = 100
+
+# Size of the spatial index cells, in the same units as the positions
+CELL_SIZE = 10
+GRID_COLUMNS = grid_columns(MAP_SIZE, CELL_SIZE)
+
+
+class FleetPositions(object):
+    ''' Stores the positions of every tracked drone in contiguous arrays. '''
+
+    def __init__(self, capacity=64):
+        self._slots = {}
+        self._size = 0
+        # Increased whenever a position changes, so readers can tell when to look again
+        self.version = 0
+        self.drone_ids = np.zeros(capacity, dtype=np.int32)
+        self.map_ids = np.full(capacity, -1, dtype=np.int32)
+        self.x = np.zeros(capacity, dtype=np.float32)
+        self.y = np.zeros(capacity, dtype=np.float32)
+        self.valid = np.zeros(capacity, dtype=np.bool_)
+        # The map and grid cell each slot is currently filed under in the spatial indexes
+        self.indexed_maps = np.full(capacity, -1, dtype=np.int32)
+        self.cells = np.full(capacity, -1, dtype=np.int64)
+
+    def __len__(self):
+        return self._size
+
+    def slot(self, drone_id):
+        ''' Retrieves the array slot of a drone, or None if it is not tracked. '''
+        return self._slots.get(drone_id)
+
+    def place(self, drone_id, map_id):
+        ''' Places a drone on a map (-1 for no map) and returns its slot. '''
+        slot = self._slots.get(drone_id)
+        if slot is None:
+            if self._size == len(self.x):
+                self._grow()
+            slot = self._size
+            self._size += 1
+            self._slots[drone_id] = slot
+            self.drone_ids[slot] = drone_id
+            self.x[slot] = np.random.randint(0, MAP_SIZE + 1)
+            self.y[slot] = np.random.randint(0, MAP_SIZE + 1)
+        elif self.map_ids[slot] == map_id:
+            return slot
+        self.map_ids[slot] = map_id
+        self._update_valid(slice(slot, slot + 1))
+        self.version += 1
+        return slot
+
+    def step(self):
+        ''' Advances every drone one step of its random walk. '''
+        n = self._size
+        moves = np.random.randint(-10, 11, size=(2, n))
+        self.x[:n] += moves[0]
+        self.y[:n] += moves[1]
+        self._update_valid(slice(0, n))
+        self.version += 1
+
+    def move(self, slots, x, y):
+        ''' Sets the positions of the given slots. '''
+        self.x[slots] = x
+        self.y[slots] = y
+        self._update_valid(slots)
+        self.version += 1
+
+    def slots_of(self, drone_ids):
+        ''' Looks up the slots of several drones, with -1 for those not tracked. '''
+        slots = self._slots
+        return np.array([slots.get(id, -1) for id in drone_ids], dtype=np.intp)
+
+    def _update_valid(self, slots):
+        x = self.x[slots]
+        y = self.y[slots]
+        self.valid[slots] = ((self.map_ids[slots] >= 0) & (x >= 0) & (x <= MAP_SIZE) &
+                             (y >= 0) & (y <= MAP_SIZE))
+
+    def _grow(self):
+        ''' Doubles the capacity of the arrays. '''
+        capacity = 2 * len(self.x)
+        for name in ('drone_ids', 'map_ids', 'x', 'y', 'valid', 'indexed_maps', 'cells'):
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        for name in ('map_ids', 'indexed_maps', 'cells'):
+            getattr(self, name)[self._size:] = -1
 
 
 class TrackingSystem(object):
@@ -6,30 +102,168 @@ class TrackingSystem(object):
 
     _initialised = False
 
+    def __init__(self, history_path=None, history_capacity=HISTORY_CAPACITY):
+        self.fleet = FleetPositions()
+        self._map_ids = {}
+        self._indexes = []
+        # Every position the drones move through, for trajectories and replays
+        self.history = PositionHistory(self.fleet, history_capacity, history_path)
+        # Started when the first subscription is made
+        self._feed = None
+
     def retrieve(self, map, drone):
         ''' Retrieves the location of a drone on a map. '''
+        return DroneLocation(self.fleet, self.track(map, drone.id))
+
+    def track(self, map, drone_id):
+        ''' Starts tracking a drone on a map and returns its slot in the fleet arrays. '''
+        return int(self.track_many(map, [drone_id])[0])
+
+    @timed('tracker.track_many', rows=lambda self, map, drone_ids: len(drone_ids))
+    def track_many(self, map, drone_ids):
+        ''' Starts tracking several drones on a map and returns their slots. '''
+        self._initialise()
+        map_id = self._map_id(map)
+        tracked = len(self.fleet)
+        slots = np.array([self.fleet.place(id, map_id) for id in drone_ids], dtype=np.intp)
+        self._reindex(slots)
+        # Record the starting positions of the drones that are new to the fleet
+        self.history.record(np.arange(tracked, len(self.fleet)), time.time())
+        return slots
+
+    def untrack(self, drone_ids):
+        ''' Stops tracking drones - they are taken off their maps. '''
+        self.track_many(None, [id for id in drone_ids if self.fleet.slot(id) is not None])
+
+    def retrieve_many(self, map, drones):
+        ''' Retrieves the locations of several drones on a map as a single batch. '''
+        return LocationBatch(self.fleet, self.track_many(map, [drone.id for drone in drones]))
+
+    @timed('tracker.step')
+    def step(self):
+        ''' Advances the whole fleet by one tracking step. '''
+        self.fleet.step()
+        slots = np.arange(len(self.fleet), dtype=np.intp)
+        self._reindex(slots)
+        self.history.record(slots, time.time())
+
+    @timed('tracker.apply_reports', rows=lambda self, drone_ids, *args, **kwargs: len(drone_ids))
+    def apply_reports(self, drone_ids, x, y, when=None):
+        ''' Moves drones to reported positions, ignoring drones that are not tracked. Returns
+        the number of drones moved. '''
+        slots = self.fleet.slots_of(np.asarray(drone_ids).tolist())
+        known = slots >= 0
+        slots = slots[known]
+        if len(slots) == 0:
+            return 0
+        self.fleet.move(slots, np.asarray(x)[known], np.asarray(y)[known])
+        self._reindex(slots)
+        self.history.record(slots, time.time() if when is None else when)
+        return len(slots)
+
+    def subscribe(self, map, rate=FEED_RATE):
+        ''' Subscribes to the positions of the drones on a map, published from a worker thread
+        up to rate times a second. Call take() on the subscription for the latest batch. '''
+        if self._feed is None:
+            self._feed = TrackingFeed(self.fleet)
+        return self._feed.subscribe(self._map_id(map), rate)
+
+    def unsubscribe(self, subscription):
+        ''' Stops a subscription made with subscribe. '''
+        if self._feed is not None:
+            self._feed.unsubscribe(subscription)
+
+    def close(self):
+        ''' Stops the feed and writes the position history still in memory to the history
+        file. '''
+        if self._feed is not None:
+            self._feed.stop()
+            self._feed = None
+        self.history.close()
+
+    def drones_on_map(self, map):
+        ''' Retrieves the IDs of the drones with a valid position on a map. '''
+        return self._drone_ids(map, lambda index: index.all_slots())
+
+    def drones_in_rect(self, map, x0, y0, x1, y1):
+        ''' Retrieves the IDs of the drones inside a rectangle on a map. '''
+        return self._drone_ids(map, lambda index: index.in_rect(x0, y0, x1, y1))
+
+    def drones_in_radius(self, map, x, y, radius):
+        ''' Retrieves the IDs of the drones within radius of a point on a map. '''
+        return self._drone_ids(map, lambda index: index.in_radius(x, y, radius))
+
+    def nearest_drones(self, map, x, y, k=1):
+        ''' Retrieves the IDs of the k drones nearest a point on a map, closest first. '''
+        return self._drone_ids(map, lambda index: index.nearest(x, y, k))
+
+    def _drone_ids(self, map, query):
+        map_id = self._map_id(map)
+        if map_id < 0:
+            return []
+        return self.fleet.drone_ids[query(self._indexes[map_id])].tolist()
+
+    def _reindex(self, slots):
+        ''' Moves the given slots to their current cells in the spatial indexes. '''
+        fleet = self.fleet
+        maps = np.where(fleet.valid[slots], fleet.map_ids[slots], -1)
+        cells = cell_of(fleet.x[slots], fleet.y[slots], CELL_SIZE, GRID_COLUMNS)
+        cells[maps < 0] = -1
+        moved = (maps != fleet.indexed_maps[slots]) | (cells != fleet.cells[slots])
+        for slot in slots[moved]:
+            if fleet.indexed_maps[slot] >= 0:
+                self._indexes[fleet.indexed_maps[slot]].remove(slot, fleet.cells[slot])
+        for slot, map_id, cell in zip(slots[moved], maps[moved], cells[moved]):
+            if map_id >= 0:
+                self._indexes[map_id].add(slot, cell)
+        fleet.indexed_maps[slots] = maps
+        fleet.cells[slots] = cells
+
+    def _initialise(self):
         if not self._initialised:
             self._initialised = True
-            random.seed()
+            np.random.seed()
 
-        return DroneLocation(map is not None)
+    def _map_id(self, map):
+        ''' Converts a map into the integer ID used by the fleet arrays. '''
+        if map is None:
+            return -1
+        if not map.name in self._map_ids:
+            self._map_ids[map.name] = len(self._indexes)
+            self._indexes.append(GridIndex(self.fleet, MAP_SIZE, CELL_SIZE))
+        return self._map_ids[map.name]
 
 
-class DroneLocation(object):
-    ''' Contains the location of a drone. '''
+class LocationBatch(object):
+    ''' Contains the locations of a group of drones, read from the fleet arrays. '''
+
+    def __init__(self, fleet, slots):
+        self._fleet = fleet
+        self.slots = slots
+
+    def __len__(self):
+        return len(self.slots)
 
-    _x = random.randint(0, 100)
-    _y = random.randint(0, 100)
+    def positions(self):
+        ''' Retrieves an (n, 2) array of the drone positions. '''
+        return np.column_stack((self._fleet.x[self.slots], self._fleet.y[self.slots]))
+
+    def valid(self):
+        ''' Retrieves a boolean array of which locations are valid. '''
+        return self._fleet.valid[self.slots]
+
+
+class DroneLocation(object):
+    ''' Contains the location of a drone - a view onto its slot in the fleet arrays. '''
 
-    def __init__(self, valid):
-        self._valid = valid
+    def __init__(self, fleet, slot):
+        self._fleet = fleet
+        self._slot = slot
 
     def is_valid(self):
         ''' Checks if this location instance is still valid. '''
-        self._x += random.randint(-10, 10)
-        self._y += random.randint(-10, 10)
-        return self._valid and (self._x >= 0) and (self._x <= 100) and (self._y >= 0) and (self._y <= 100)
+        return bool(self._fleet.valid[self._slot])
 
     def position(self):
         ''' Retrieves the position of the drone on the map. '''
-        return (self._x, self._y, 1)
+        return (float(self._fleet.x[self._slot]), float(self._fleet.y[self._slot]), 1)
@@ -0,0 +1,259 @@
+import time
+from contextlib import contextmanager
+
+from backends import DRONE_COLUMNS, OPERATOR_COLUMNS
+from metrics import timed
+
+
+def drone_row(drone):
+    """ Returns the database row for a drone. """
+    # The map is held by name until the application resolves it to a Map
+    map_name = getattr(drone.map, 'name', drone.map)
+    return (drone.id, drone.name, drone.class_type, int(drone.rescue), drone.operator, map_name)
+
+
+def operator_row(operator):
+    """ Returns the database row for an operator. """
+    return (operator.id, operator.first_name, operator.family_name, operator.date_of_birth,
+            operator.drone_license, int(operator.rescue_endorsement), operator.operations,
+            operator.drone)
+
+
+def split_changes(records, to_row, columns, sending=None):
+    """ Sorts changed records into the rows of new records, the full rows of those whose
+    database row is not known, and (ID, column names, values) updates holding only the columns
+    changed since the others were last loaded or written. Records that have not changed are
+    left out. Also returns the (record, row) pairs being written.
+
+    New records are those whose _saved row is None, and an empty _saved row means the record
+    is written whole.
+
+    sending maps the IDs of records with a write still in flight to the row being written.
+    Those records are compared against that row instead, and written whole, as the earlier
+    write may yet fail. """
+    sending = sending or {}
+    inserts = []
+    rows = []
+    updates = []
+    written = []
+    for record in records:
+        row = to_row(record)
+        saved = record._saved
+        if record.id in sending:
+            if row == sending[record.id]:
+                continue
+            rows.append(row)
+        elif saved is None:
+            inserts.append(row)
+        elif not saved or saved[0] != row[0]:
+            rows.append(row)
+        elif row != saved:
+            changed = [index for index in xrange(1, len(row)) if row[index] != saved[index]]
+            updates.append((row[0], tuple(columns[index] for index in changed),
+                            tuple(row[index] for index in changed)))
+        else:
+            continue
+        written.append((record, row))
+    return inserts, rows, updates, written
+
+
+class UnitOfWork(object):
+    """ Records changed drones and operators and writes them to the database in batches. """
+
+    def __init__(self, backend, max_pending=100, max_delay=2.0, worker=None):
+        self._backend = backend
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        # When a DatabaseWorker is given, flushes are written on its thread
+        self.worker = worker
+        self._drones = {}
+        self._operators = {}
+        self._removed_drones = set()
+        self._first_change = None
+        # Records being written and records whose last write failed, keyed by (kind, ID)
+        self._saving = {}
+        self._failed = {}
+        # The row last sent to the database for each record whose write is still in flight
+        self._sending = {'drone': {}, 'operator': {}}
+        self._listeners = []
+        # Depth of the transaction blocks being run - nothing is flushed while inside one
+        self._transactions = 0
+
+    def register_drone(self, drone):
+        """ Marks a drone as needing to be written. """
+        self._removed_drones.discard(drone.id)
+        self._drones[drone.id] = drone
+        self._changed([('drone', drone.id)])
+
+    def register_operator(self, operator):
+        """ Marks an operator as needing to be written. """
+        self._operators[operator.id] = operator
+        self._changed([('operator', operator.id)])
+
+    def register_removed_drone(self, drone):
+        """ Marks a drone as needing to be deleted. """
+        self._drones.pop(drone.id, None)
+        self._removed_drones.add(drone.id)
+        self._changed([('drone', drone.id)])
+
+    def needs_write(self, kind, record, row):
+        """ Returns True if a 'drone' or 'operator' record's row differs from the row in the
+        database, or from the row on its way there if a write is in flight. """
+        return row != self._sending[kind].get(record.id, record._saved)
+
+    def pending(self):
+        """ Returns the number of records waiting to be written. """
+        return len(self._drones) + len(self._operators) + len(self._removed_drones)
+
+    def saving(self):
+        """ Returns the number of records currently being written. """
+        return len(self._saving)
+
+    def failures(self):
+        """ Returns the error message of each record whose last write failed, keyed by
+        (kind, ID). """
+        return dict(self._failed)
+
+    def state(self, kind, id):
+        """ Returns 'failed', 'pending' or None (saved) for a 'drone' or 'operator' record. """
+        if (kind, id) in self._failed:
+            return 'failed'
+        elif (kind, id) in self._saving or self._is_pending(kind, id):
+            return 'pending'
+        else:
+            return None
+
+    def add_listener(self, listener):
+        """ Adds a function called with the (kind, ID) keys of records whose state changes. """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """ Removes a listener added with add_listener. """
+        self._listeners.remove(listener)
+
+    @contextmanager
+    def transaction(self):
+        """ Holds back the changes registered inside the block, then writes them all in one
+        transaction when the outermost block ends. """
+        self._transactions += 1
+        try:
+            yield self
+        finally:
+            self._transactions -= 1
+        if self._transactions == 0:
+            self.flush()
+
+    def is_due(self):
+        """ Returns True if the pending changes have reached the count or delay limit. """
+        if self._first_change is None or self._transactions:
+            return False
+        if self.pending() >= self.max_pending:
+            return True
+        return time.time() - self._first_change >= self.max_delay
+
+    def flush_if_due(self):
+        """ Flushes the pending changes if the count or delay limit has been reached. """
+        if self.is_due():
+            self.flush()
+
+    @timed('unit_of_work.flush', rows=lambda self: self.pending())
+    def flush(self):
+        """ Writes all the pending changes in a single transaction - on the worker thread if
+        there is a worker, otherwise straight away. """
+        if self.pending() == 0:
+            return
+
+        # The rows are built now, so later edits do not change what this flush writes
+        removed = list(self._removed_drones)
+        drones = self._drones
+        operators = self._operators
+        drone_inserts, drone_rows, drone_updates, written_drones = split_changes(
+            drones.values(), drone_row, DRONE_COLUMNS, self._sending['drone'])
+        operator_inserts, operator_rows, operator_updates, written_operators = split_changes(
+            operators.values(), operator_row, OPERATOR_COLUMNS, self._sending['operator'])
+        written = ([('drone', record, row) for record, row in written_drones] +
+                   [('operator', record, row) for record, row in written_operators])
+        batch = (removed, drone_rows, operator_rows, drone_updates, operator_updates,
+                 drone_inserts, operator_inserts)
+        keys = ([('drone', id) for id in removed] + [('drone', id) for id in drones] +
+                [('operator', id) for id in operators])
+
+        self._drones = {}
+        self._operators = {}
+        self._removed_drones = set()
+        self._first_change = None
+        for key in keys:
+            self._saving[key] = self._saving.get(key, 0) + 1
+        for kind, record, row in written:
+            self._sending[kind][record.id] = row
+
+        if not any(batch):
+            # Every record was changed back to how it was saved
+            self._written(keys, written)
+        elif self.worker is None:
+            try:
+                self._backend.write(*batch)
+            except Exception as error:
+                self._write_failed(keys, written, removed, drones, operators, error)
+                raise
+            self._written(keys, written)
+        else:
+            self.worker.submit(lambda backend: backend.write(*batch),
+                               lambda result: self._written(keys, written),
+                               lambda error: self._write_failed(keys, written, removed, drones,
+                                                                operators, error))
+            self._notify(keys)
+
+    def _written(self, keys, written):
+        """ Records that a batch has been written, along with the rows each record now has in
+        the database. """
+        for kind, record, row in written:
+            record._saved = row
+        self._finished(keys, written)
+        for key in keys:
+            self._failed.pop(key, None)
+        self._notify(keys)
+
+    def _write_failed(self, keys, written, removed, drones, operators, error):
+        """ Records that a batch could not be written and queues its records to be retried,
+        unless they have been changed again since. """
+        self._finished(keys, written)
+        for key in keys:
+            self._failed[key] = str(error)
+        for drone_id in removed:
+            if not drone_id in self._drones:
+                self._removed_drones.add(drone_id)
+        for id, drone in drones.iteritems():
+            if not id in self._removed_drones:
+                self._drones.setdefault(id, drone)
+        for id, operator in operators.iteritems():
+            self._operators.setdefault(id, operator)
+        # Wait a full delay before retrying
+        self._first_change = time.time()
+        self._notify(keys)
+
+    def _finished(self, keys, written):
+        for key in keys:
+            self._saving[key] -= 1
+            if self._saving[key] == 0:
+                del self._saving[key]
+        # A later flush may have sent a newer row that is still in flight
+        for kind, record, row in written:
+            if self._sending[kind].get(record.id) is row:
+                del self._sending[kind][record.id]
+
+    def _is_pending(self, kind, id):
+        if kind == 'drone':
+            return id in self._drones or id in self._removed_drones
+        return id in self._operators
+
+    def _notify(self, keys):
+        for listener in list(self._listeners):
+            listener(keys)
+
+    def _changed(self, keys):
+        """ Records the time of the first pending change and flushes when due. """
+        if self._first_change is None:
+            self._first_change = time.time()
+        self._notify(keys)
+        self.flush_if_due()